@@ -5,11 +5,13 @@ from flask_security.datastore import Datastore, UserDatastore
 import rdfalchemy
 from rdfalchemy.descriptors import value2object
 from rdflib import *
-from flask import make_response
+from flask import make_response, Response, g, has_app_context
 import uuid
 from copy import copy
+from collections import OrderedDict
 import flask_restful as restful
-from .utils import lru
+from .utils import Cache, iter_lines, line_formats
+from .jsonld import build_context, serialize_jsonld
 import hashlib
 
 def public(obj):
@@ -25,6 +27,13 @@ void = Namespace("http://rdfs.org/ns/void#")
 auth = Namespace("http://vocab.rpi.edu/auth/")
 foaf = Namespace("http://xmlns.com/foaf/0.1/")
 
+graph_pointers = (auth.inPrivateDataset, auth.inLDDataset, void.inDataset)
+
+_pointer_query = '''SELECT ?p ?o WHERE {
+    VALUES ?p { %s }
+    %s ?p ?o
+}'''
+
 def load_namespaces(g, l):
     #print g.namespace_manager
     loc = {}
@@ -35,22 +44,26 @@ def load_namespaces(g, l):
             g.bind(local, loc[local])
 
 class Serializer(object):
-    def __init__(self,format):
+    def __init__(self,format,chunk_size=1000):
         self.format = format
+        self.chunk_size = chunk_size
     def __call__(self, graph, code, headers=None):
-        resp = make_response(graph.serialize(format=self.format),code)
+        if self.format in line_formats and len(graph) > self.chunk_size:
+            resp = Response(iter_lines(graph, self.format, self.chunk_size), code)
+        else:
+            resp = make_response(graph.serialize(format=self.format),code)
         resp.headers.extend(headers or {})
         return resp
 
-def JsonldSerializer(graph, code, headers=None):
-    context = dict([(x[0],str(x[1])) for x in graph.namespace_manager.namespaces()])
-    #print context
-    resp = make_response(graph.serialize(format='json-ld', context=context, indent=4).decode(),code)
+def JsonldSerializer(graph, code, headers=None, context=None):
+    resp = make_response(serialize_jsonld(graph, context).decode('utf-8'),code)
     resp.headers.extend(headers or {})
     return resp    
 
 class Api(restful.Api):
     def __init__(self, *args, **kwargs):
+        # the JSON-LD context: given, or built from the first graph served
+        self.context = kwargs.pop('context', None)
         super(Api, self).__init__(*args, **kwargs)
         self.representations = {
             'application/xml': Serializer("xml"),
@@ -61,11 +74,18 @@ class Api(restful.Api):
             'application/x-turtle':Serializer('turtle'),
             'text/html':Serializer('json-ld'),
             'text/plain':Serializer('nt'),
+            'application/n-triples':Serializer('nt'),
+            'application/n-quads':Serializer('nquads'),
             'text/n3':Serializer('n3'),
 #            'text/html': output_html,
-            'application/json': JsonldSerializer,
+            'application/json': self.jsonld,
         }
 
+    def jsonld(self, graph, code, headers=None):
+        if self.context is None:
+            self.context = build_context(graph)
+        return JsonldSerializer(graph, code, headers, self.context)
+
 
 class rdfSingle(rdfalchemy.rdfSingle):
 
@@ -99,6 +119,8 @@ class rdfSingle(rdfalchemy.rdfSingle):
         obj.__dict__[self.name] = value
         o = value2object(value)
         self.graph(obj)[0].set((obj.resUri, self.pred, o))
+        if self.pred in graph_pointers and obj.datastore is not None:
+            obj.datastore.graph_assignments.invalidate(obj.resUri)
 
 class rdfMultiple(rdfalchemy.rdfMultiple):
 
@@ -188,30 +210,50 @@ class Resource(rdfalchemy.rdfSubject):
         elif not self.lod_graph:
             self.lod_graph = self.ld_graph
 
-    def _introspect_graphs(self, resUri):
-        private_uri = self.base_db.value(resUri,auth.inPrivateDataset)
+    def _named_graph(self, uri):
+        datastore = getattr(self.base_db, 'datastore', None)
+        if datastore is not None:
+            return datastore.named_graph(uri)
+        return Graph(self.base_db.store, uri, self.base_db.namespace_manager)
+
+    def _assign_graphs(self, private_uri, ld_uri, lod_uri):
         if private_uri:
-            self.private_graph = Graph(self.base_db.store,private_uri,
-                                       self.base_db.namespace_manager)
+            self.private_graph = self._named_graph(private_uri)
             #self.db = self.private_graph
         else:
             self.private_graph = self.base_db
-        ld_uri = self.base_db.value(resUri,auth.inLDDataset)
         if ld_uri:
-            self.ld_graph = Graph(self.base_db.store,ld_uri,
-                                  self.base_db.namespace_manager)
+            self.ld_graph = self._named_graph(ld_uri)
             #self.db = self.ld_graph
         else:
             self.ld_graph = self.private_graph
-        lod_uri = self.base_db.value(resUri,void.inDataset)
         if lod_uri:
-            self.lod_graph = Graph(self.base_db.store,lod_uri,
-                                   self.base_db.namespace_manager)
+            self.lod_graph = self._named_graph(lod_uri)
             #self.db = self.lod_graph
         else:
             self.lod_graph = self.ld_graph
 
-    def __init__(self, resUri=None, id=None, **kwargs):
+    def _introspect_graphs(self, resUri):
+        datastore = getattr(self.base_db, 'datastore', None)
+        graphs = None
+        if datastore is not None:
+            graphs = datastore.graph_assignments.get(resUri)
+        if graphs is None:
+            pointers = {}
+            if isinstance(resUri, URIRef):
+                query = _pointer_query % (' '.join(p.n3() for p in graph_pointers), resUri.n3())
+                for p, o in self.base_db.query(query):
+                    pointers.setdefault(p, o)
+            elif resUri is not None:
+                # blank nodes cannot be named in a query
+                for p in graph_pointers:
+                    pointers[p] = self.base_db.value(resUri, p)
+            graphs = tuple(pointers.get(p) for p in graph_pointers)
+            if datastore is not None and resUri is not None:
+                datastore.graph_assignments.put(resUri, graphs)
+        self._assign_graphs(*graphs)
+
+    def __init__(self, resUri=None, id=None, graphs=None, **kwargs):
         self.base_db = self.db
 
         if resUri == None and id != None:
@@ -219,6 +261,9 @@ class Resource(rdfalchemy.rdfSubject):
         
         if len(kwargs) > 0:
             self._setup_from_graph_templates(**kwargs)
+        elif graphs is not None:
+            # (private, LD, LOD) dataset URIs already looked up in bulk
+            self._assign_graphs(*graphs)
         else:
             self._introspect_graphs(resUri)
         if resUri == None and self.uri_template != None:
@@ -263,10 +308,45 @@ def tag_datastore(fn):
 
 class RDFAlchemyDatastore(Datastore):
 
-    def __init__(self, db, classes):
+    def __init__(self, db, classes, cache=None, chunk_size=100, assignment_ttl=300):
         Datastore.__init__(self, db)
         db.datastore = self
         self.classes = classes
+        self.chunk_size = chunk_size
+        if cache is None:
+            cache = Cache(maxsize=1000)
+        self.cache = cache
+        # resource URI -> (private, LD, LOD) dataset URIs. Entries are
+        # evicted by writes through the datastore and through any watched
+        # LocalResource, and expire after assignment_ttl seconds in case
+        # the store is written some other way.
+        self.graph_assignments = Cache(maxsize=10000, ttl=assignment_ttl)
+        self._graphs = Cache(maxsize=1000)
+        self._watched = set()
+        for cls in list(classes.values()):
+            local_api = getattr(cls, '_local_api', None)
+            if local_api is not None:
+                self.watch(local_api)
+
+    def watch(self, local_resource):
+        '''Evicts resources written through local_resource (a
+        flaskld.LocalResource) from this datastore's caches.'''
+        if id(local_resource) not in self._watched:
+            self._watched.add(id(local_resource))
+            local_resource.on_invalidate(self.evict)
+
+    def named_graph(self, uri):
+        '''A shared Graph wrapper for the named graph uri.'''
+        graph = self._graphs.get(uri)
+        if graph is None:
+            graph = Graph(self.db.store, uri, self.db.namespace_manager)
+            self._graphs.put(uri, graph)
+        return graph
+
+    def evict(self, resUri):
+        self.cache.invalidate(resUri)
+        self.cache.invalidate_prefix(str(resUri) + '#')
+        self.graph_assignments.invalidate(resUri)
 
     def commit(self):
         self.db.commit()
@@ -281,14 +361,115 @@ class RDFAlchemyDatastore(Datastore):
             model = model.local_api.alchemy(newURI)
         else:
             model.local_api.update(model.db, model.resUri)
+        self.evict(model.resUri)
         return model
 
     def delete(self, model):
+        self.evict(model.resUri)
         self.db.remove(model)
 
-    @lru
+    def get(self, resUri):
+        result = self.cache.get(resUri)
+        if result is None:
+            result = self._load(resUri)
+            self.cache.put(resUri, result)
+        return result
+
+    _bulk_query = '''SELECT ?s ?p ?o WHERE {
+    VALUES ?s { %s }
+    VALUES ?p { %s }
+    ?s ?p ?o
+}'''
+
+    def _class_for(self, types):
+        for t in types:
+            if str(t) in self.classes:
+                return self.classes[str(t)]
+        return None
+
+    def _build(self, resUri, cls, graphs, description=None):
+        if cls is None:
+            result = Resource(resUri, graphs=graphs)
+        else:
+            if isinstance(cls, type) and issubclass(cls, Resource):
+                result = cls(resUri, graphs=graphs)
+            elif description is not None:
+                result = cls.from_description(resUri, description)
+            else:
+                result = cls(resUri)
+            result.datasource = self
+        result.datastore = self
+        return result
+
+    def _get_many(self, uris):
+        result = OrderedDict()
+        missing = []
+        for uri in uris:
+            if uri in result:
+                continue
+            result[uri] = self.cache.get(uri)
+            if result[uri] is None:
+                if isinstance(uri, URIRef):
+                    missing.append(uri)
+                else:
+                    result[uri] = self.get(uri)
+        predicates = ' '.join(p.n3() for p in (RDF.type,) + graph_pointers)
+        for i in range(0, len(missing), self.chunk_size):
+            chunk = missing[i:i+self.chunk_size]
+            found = dict((uri, ([], {})) for uri in chunk)
+            query = self._bulk_query % (' '.join(uri.n3() for uri in chunk), predicates)
+            for s, p, o in self.db.query(query):
+                types, pointers = found[s]
+                if p == RDF.type:
+                    types.append(o)
+                else:
+                    pointers.setdefault(p, o)
+            classes = dict((uri, self._class_for(found[uri][0])) for uri in chunk)
+            # models from flaskld.create_model get their descriptions read
+            # in bulk, one query per LocalResource
+            descriptions = {}
+            by_api = {}
+            for uri, cls in classes.items():
+                local_api = getattr(cls, '_local_api', None)
+                if local_api is not None and hasattr(cls, 'from_description'):
+                    by_api.setdefault(local_api, []).append(uri)
+            for local_api, uris in by_api.items():
+                descriptions.update(local_api.read_many(uris))
+            for uri in chunk:
+                types, pointers = found[uri]
+                graphs = tuple(pointers.get(p) for p in graph_pointers)
+                self.graph_assignments.put(uri, graphs)
+                result[uri] = self._build(uri, classes[uri], graphs, descriptions.get(uri))
+                self.cache.put(uri, result[uri])
+        return result
+
+    def get_many(self, uris, paths=()):
+        '''Loads uris into the cache, resolving their types and datasets in
+        one query per chunk_size resources, and returns them in order. paths
+        are dotted descriptor names, such as "roles" or "roles.permissions",
+        whose targets are loaded in bulk the same way, one level at a time.'''
+        uris = [uri if isinstance(uri, (URIRef, BNode)) else URIRef(uri) for uri in uris]
+        loaded = self._get_many(uris)
+        for path in paths:
+            objs = list(loaded.values())
+            for name in path.split('.'):
+                targets = []
+                for obj in objs:
+                    descriptor = getattr(type(obj), name, None)
+                    if isinstance(descriptor, (rdfSingle, rdfMultiple)):
+                        db = descriptor.graph(obj)[1]
+                    elif isinstance(descriptor, (rdfalchemy.rdfSingle, rdfalchemy.rdfMultiple)):
+                        # flaskld.create_model descriptors
+                        db = obj.db
+                    else:
+                        continue
+                    targets.extend(o for o in db.objects(obj.resUri, descriptor.pred)
+                                   if not isinstance(o, Literal))
+                objs = list(self._get_many(targets).values())
+        return [loaded[uri] for uri in uris]
+
     @tag_datastore
-    def get(self,resUri):
+    def _load(self,resUri):
         #print resUri, 'a', [x for x in self.db.objects(resUri,rdfalchemy.RDF.type)]
         for t in self.db.objects(resUri,rdfalchemy.RDF.type):
             if str(t) in self.classes:
@@ -301,12 +482,93 @@ class RDFAlchemyUserDatastore(RDFAlchemyDatastore, UserDatastore):
     """A SQLAlchemy datastore implementation for Flask-Security that assumes the
     use of the Flask-SQLAlchemy extension.
     """
-    def __init__(self, db, classes, user_model, role_model):
+    def __init__(self, db, classes, user_model, role_model, identity_ttl=None):
         RDFAlchemyDatastore.__init__(self, db, classes)
         UserDatastore.__init__(self, user_model, role_model)
+        # Users and roles are memoized for the length of a request, and for
+        # identity_ttl seconds across requests if it is given.
+        # The process-wide cache holds frozen snapshots, and each lookup
+        # builds its own instance from one, so requests never share models.
+        self.identities = None
+        if identity_ttl:
+            self.identities = Cache(maxsize=1000, ttl=identity_ttl)
+        # edits through the admin or REST API must not leave stale identities
+        for model in (user_model, role_model):
+            local_api = getattr(model, '_local_api', None)
+            if local_api is not None:
+                local_api.on_invalidate(lambda uri: self.clear_identities())
+                self.watch(local_api)
+
+    def _request_identities(self):
+        if not has_app_context():
+            return None
+        memo = getattr(g, '_flaskld_identities', None)
+        if memo is None:
+            memo = g._flaskld_identities = {}
+        return memo
+
+    def _identity(self, key, load):
+        try:
+            hash(key)
+        except TypeError:
+            return load()
+        memo = self._request_identities()
+        if memo is not None and key in memo:
+            return memo[key]
+        result = None
+        if self.identities is not None:
+            frozen = self.identities.get(key)
+            if frozen is not None:
+                result = self._thaw(frozen)
+        if result is None:
+            result = load()
+            if result is not None and self.identities is not None:
+                self.identities.put(key, self._freeze(result))
+        if memo is not None:
+            memo[key] = result
+        return result
+
+    def _freeze(self, model):
+        triples = None
+        if hasattr(type(model), 'from_description'):
+            # a flaskld.create_model model: keep its description
+            triples = tuple(model.db)
+        return (type(model), model.resUri, triples)
+
+    def _thaw(self, frozen):
+        cls, uri, triples = frozen
+        if triples is None:
+            result = cls(uri)
+        else:
+            graph = Graph(identifier=uri)
+            graph += triples
+            result = cls.from_description(uri, graph)
+        result.datastore = self
+        return result
+
+    def clear_identities(self):
+        if self.identities is not None:
+            self.identities.clear()
+        memo = self._request_identities()
+        if memo is not None:
+            memo.clear()
+
+    def put(self, model):
+        model = RDFAlchemyDatastore.put(self, model)
+        if isinstance(model, (self.user_model, self.role_model)):
+            self.clear_identities()
+        return model
+
+    def delete(self, model):
+        RDFAlchemyDatastore.delete(self, model)
+        if isinstance(model, (self.user_model, self.role_model)):
+            self.clear_identities()
 
-    @tag_datastore
     def get_user(self, identifier):
+        return self._identity(('user', identifier), lambda: self._get_user(identifier))
+
+    @tag_datastore
+    def _get_user(self, identifier):
         if isinstance(identifier,rdfalchemy.URIRef):
             return self.user_model.query.get(identifier)
         for attr in ['name','email','identifier']:
@@ -325,8 +587,12 @@ class RDFAlchemyUserDatastore(RDFAlchemyDatastore, UserDatastore):
             return False
         return True
 
-    @tag_datastore
     def find_user(self, **kwargs):
+        key = ('find_user',) + tuple(sorted(kwargs.items()))
+        return self._identity(key, lambda: self._find_user(**kwargs))
+
+    @tag_datastore
+    def _find_user(self, **kwargs):
         #print kwargs
         if 'id' in kwargs:
             return self.user_model(uri=rdfalchemy.URIRef(kwargs['id']))
@@ -335,8 +601,12 @@ class RDFAlchemyUserDatastore(RDFAlchemyDatastore, UserDatastore):
         except:
             return None
 
-    @tag_datastore
     def find_role(self, role, **kwargs):
+        key = ('find_role', role) + tuple(sorted(kwargs.items()))
+        return self._identity(key, lambda: self._find_role(role, **kwargs))
+
+    @tag_datastore
+    def _find_role(self, role, **kwargs):
         #print kwargs
         if 'id' in kwargs:
             return self.role_model(rdfalchemy.URIRef(kwargs['id']))
@@ -1,41 +1,74 @@
 from __future__ import absolute_import
-from builtins import bytes
 from builtins import str
 from builtins import object
 from rdflib import *
 from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.sparql import Query
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.util import from_n3
+from rdflib.compare import isomorphic
+from rdflib.collection import Collection
 import base64
-import random
+import calendar
+import json
+import threading
+import time
 from datetime import datetime
 import re
+from collections import OrderedDict
 from flask import Flask, request, make_response, render_template, g, session, abort
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
 from flask_admin import BaseView, expose
 from flask_admin.actions import ActionsMixin
 
-from flask_ld.utils import slugify
+from flask_ld.utils import slugify, Cache, RWLock, allocate_id
+from flask_ld.writer import BatchWriter, is_remote, has_blank
 
 import rdfalchemy
 from flask_admin.model import BaseModelView
 
-from .form import get_form, get_label
+from .form import get_form, get_label, invalidate_choices
+from .schema import compile_schema
 
 import sadi
 
+from jinja2 import Template
+
 dc = Namespace("http://purl.org/dc/terms/")
 flaskld = Namespace("http://vocab.rpi.edu/flaskld/")
 
-from jinja2 import Template
 
-def create_sparql_store(endpoint, update_endpoint=None, use_let_syntax=False):
+def create_sparql_store(endpoint, update_endpoint=None, use_let_syntax=False,
+                        pool_size=None, timeout=None, pool_timeout=None):
     if update_endpoint == None:
         update_endpoint = endpoint
-    store = SPARQLUpdateStore(queryEndpoint=endpoint,
-                              update_endpoint=update_endpoint)
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    if pool_size is not None:
+        from .transport import ConnectionPool, PooledSPARQLUpdateStore
+        try:
+            from urllib.parse import urlparse
+        except ImportError:
+            from urlparse import urlparse
+        hosts = len(set(urlparse(e).netloc for e in (endpoint, update_endpoint)))
+        store = PooledSPARQLUpdateStore(queryEndpoint=endpoint,
+                                        update_endpoint=update_endpoint,
+                                        transport=ConnectionPool(pool_size, pool_timeout,
+                                                                 hosts=hosts),
+                                        **kwargs)
+    else:
+        store = SPARQLUpdateStore(queryEndpoint=endpoint,
+                                  update_endpoint=update_endpoint, **kwargs)
     store.open((endpoint,update_endpoint))
     return store
 
 def create_id():
-    return base64.urlsafe_b64encode(bytes(random.random()*datetime.now().toordinal())).rstrip("=")
+    return allocate_id()
 
 def describe(store, uri, outputGraph):
     query = '''PREFIX hint: <http://www.bigdata.com/queryHints#>
@@ -46,6 +79,122 @@ describe %s where { hint:Query hint:describeMode "CBD". }'''
     except:
         outputGraph += g.query("select ?s ?p ?o where { ?s ?p ?o}", initBindings={"s":uri})
 
+_describe_many_query = Template('''
+    construct { ?s ?p ?o. ?b ?bp ?bo. ?gs ?gp ?go } where {
+        values ?s { {% for uri in uris %}{{uri.n3()}} {% endfor %}}
+        { ?s ?p ?o }
+        union { ?s ?p ?b. filter(isBlank(?b)) ?b ?bp ?bo }
+        union { graph ?s { ?gs ?gp ?go } }
+    }''')
+
+def describe_many(store, uris, outputGraph, chunk_size=100):
+    '''Adds to outputGraph what describe() gives for each of uris, in one
+    query per chunk_size resources: the statements about each resource,
+    the statements about blank nodes it refers to (one level deep), and
+    the contents of its named graph.'''
+    uris = list(uris)
+    g = ConjunctiveGraph(store)
+    for i in range(0, len(uris), chunk_size):
+        query = _describe_many_query.render(uris=uris[i:i+chunk_size])
+        outputGraph += g.query(query)
+
+def encode_cursor(values):
+    data = json.dumps([v.n3() for v in values]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip("=")
+
+_unsafe_iri_re = re.compile(r'[\x00-\x20<>"{}|\\^`]')
+
+def _cursor_term(value):
+    if isinstance(value, Literal):
+        iri = value.datatype
+    elif isinstance(value, URIRef):
+        iri = value
+    else:
+        raise ValueError("Cursor values must be IRIs or literals.")
+    if iri is not None and _unsafe_iri_re.search(iri):
+        raise ValueError("Invalid IRI in cursor.")
+    return value
+
+def decode_cursor(token):
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode((token + "=" * (-len(token) % 4)).encode('ascii'))
+        return [_cursor_term(from_n3(v)) for v in json.loads(data.decode('utf-8'))]
+    except Exception:
+        raise ValueError("Invalid pagination cursor: %s" % token)
+
+def next_link(cursor):
+    args = request.args.to_dict()
+    args.pop('offset', None)
+    args['after'] = cursor
+    return '<%s?%s>; rel="next"' % (request.base_url, urlencode(args))
+
+def _keyset_filter(keys, values, desc=False, inline=True):
+    op = '<' if desc else '>'
+    def term(var, value):
+        if isinstance(value, URIRef):
+            return 'str(%s)' % var
+        return var
+    clauses = []
+    for i, (key, value) in enumerate(zip(keys, values)):
+        after = '?_after_' + key
+        conditions = ['%s = %s' % (term('?'+k, v), term('?_after_'+k, v))
+                      for k, v in zip(keys[:i], values[:i])]
+        conditions.append('%s %s %s' % (term('?'+key, value), op, term(after, value)))
+        clauses.append('(%s)' % ' && '.join(conditions))
+    result = 'filter(%s)' % ' || '.join(clauses)
+    if inline:
+        result = 'values (%s) { (%s) }\n%s' % (
+            ' '.join('?_after_' + k for k in keys),
+            ' '.join(v.n3() for v in values),
+            result)
+    return result
+
+def _keyset_bindings(keys, values):
+    return dict([('_after_' + k, v) for k, v in zip(keys, values)])
+
+_prologue_re = re.compile(r'^(\s*(?:(?:prefix|base)\s[^<]*<[^>]*>\s*)*)(.*)$', re.I | re.S)
+
+def _keyset_query(query, keys, after, inline=True):
+    prologue, body = _prologue_re.match(query).groups()
+    result = prologue + 'select * where {\n{ %s }\n' % body
+    if after is not None:
+        result += _keyset_filter(keys, after, inline=inline)
+    result += '\n} order by %s' % ' '.join('?' + k for k in keys)
+    return result
+
+_prepared_queries = Cache(maxsize=500)
+
+def prepare_query(db, query):
+    namespaces = tuple(sorted(db.namespaces()))
+    key = (query, namespaces)
+    prepared = _prepared_queries.get(key)
+    if prepared is None:
+        prepared = prepareQuery(query, initNs=dict(namespaces))
+        _prepared_queries.put(key, prepared)
+    return prepared
+
+def _slice(prepared, offset=None, limit=None):
+    if not offset and limit is None:
+        return prepared
+    algebra = CompValue(prepared.algebra.name, **dict(prepared.algebra))
+    algebra['p'] = CompValue('Slice', p=algebra['p'], start=offset or 0, length=limit)
+    return Query(prepared.prologue, algebra)
+
+def run_query(db, query, initBindings=None, offset=None, limit=None):
+    '''Runs a query against db, paginated by offset and limit. Local stores
+    use a cached, prepared form of the query, with the page applied to its
+    algebra; remote SPARQL stores get the query text as usual.'''
+    initBindings = initBindings or {}
+    if is_remote(db.store):
+        if limit is not None:
+            query += '\nLIMIT %s' % int(limit)
+        if offset:
+            query += '\nOFFSET %s' % int(offset)
+        return db.query(query, initBindings=initBindings)
+    return db.query(_slice(prepare_query(db, query), offset, limit),
+                    initBindings=initBindings)
+
 def _create_binding(value, datatype):
     if datatype == URIRef:
         return URIRef(value)
@@ -54,13 +203,9 @@ def _create_binding(value, datatype):
     else:
         return Literal(value)
 
-def sparql_select(fn):
+def _register_sparql_plugins():
     import rdflib.plugin
-    from rdflib.store import Store
-    from rdflib.parser import Parser
-    from rdflib.serializer import Serializer
-    from rdflib.query import ResultParser, ResultSerializer, Processor, Result, UpdateProcessor
-    from rdflib.exceptions import Error
+    from rdflib.query import Processor, Result, UpdateProcessor
     rdflib.plugin.register('sparql', Result,
                            'rdflib.plugins.sparql.processor', 'SPARQLResult')
     rdflib.plugin.register('sparql', Processor,
@@ -68,23 +213,79 @@ def sparql_select(fn):
     rdflib.plugin.register('sparql', UpdateProcessor,
                            'rdflib.plugins.sparql.processor', 'SPARQLUpdateProcessor')
 
+_register_sparql_plugins()
+
+def sparql_select(fn):
     def wrapper(*args, **kwargs):
-        db, query, parameters = fn(*args, **kwargs)
+        result = fn(*args, **kwargs)
+        db, query, parameters = result[:3]
+        keys = result[3] if len(result) > 3 else None
         bindings = dict([(name, _create_binding(request.args[name],datatype)) 
                     for name, datatype in list(parameters.items()) 
                     if name in request.args])
+        limit = None
         if 'limit' in request.args:
-            query += '\nLIMIT %s' % int(request.args['limit'])
-        if 'offset' in request.args:
-            query += '\nOFFSET %s' % int(request.args['offset'])
+            limit = int(request.args['limit'])
+        offset = int(request.args.get('offset', 0))
+        if keys and 'offset' not in request.args:
+            after = None
+            if 'after' in request.args:
+                try:
+                    after = decode_cursor(request.args['after'])
+                except ValueError as e:
+                    abort(400, str(e))
+                if len(after) != len(keys):
+                    abort(400, "Pagination cursor does not match this query.")
+            inline = is_remote(db.store)
+            query = _keyset_query(query, keys, after, inline)
+            if after is not None and not inline:
+                bindings.update(_keyset_bindings(keys, after))
 
         contentType = request.headers['Accept']
         if 'user_id' in session:
             bindings['user'] = URIRef(session['user_id'])
-        return sadi.serialize(db.query(query, initBindings=bindings),contentType)
+        results = run_query(db, query, bindings, offset, limit)
+        cursor = None
+        if keys and limit is not None and len(results.bindings) == limit:
+            last = results.bindings[-1]
+            cursor = encode_cursor([last[Variable(k)] for k in keys])
+        resp = make_response(sadi.serialize(results,contentType))
+        if cursor is not None:
+            resp.headers['Link'] = next_link(cursor)
+        return resp
     wrapper.__name__ = fn.__name__
     return wrapper
 
+def graph_delta(old, new):
+    '''Returns (removals, additions, blank) to turn the triples in old into
+    those in new. Triples without blank nodes are diffed directly. Triples
+    with blank nodes cannot be matched by identity, so they are compared
+    by isomorphism; if they differ, blank is True and all of them are
+    replaced: the old ones are included in removals and the new ones in
+    additions.'''
+    old_ground, old_blank, new_ground, new_blank = set(), Graph(), set(), Graph()
+    for t in old:
+        if has_blank(t):
+            old_blank.add(t)
+        else:
+            old_ground.add(t)
+    for t in new:
+        if has_blank(t):
+            new_blank.add(t)
+        else:
+            new_ground.add(t)
+    removals = old_ground - new_ground
+    additions = new_ground - old_ground
+    blank = False
+    if (len(old_blank) > 0 or len(new_blank) > 0) and not isomorphic(old_blank, new_blank):
+        blank = True
+        removals.update(old_blank)
+        additions.update(new_blank)
+    return removals, additions, blank
+
+def version_tag(modified):
+    return '%x' % (calendar.timegm(modified.utctimetuple()) * 1000000 + modified.microsecond)
+
 def rebase(graph, inputUri, uri):
     def replace(x):
         if isinstance(x, Graph):
@@ -101,15 +302,142 @@ def rebase(graph, inputUri, uri):
     for t in graph:
         yield tuple([replace(x) for x in t])
 
+def graph_size(triples):
+    return sum(len(s) + len(p) + len(o) + 64 for s, p, o in triples)
+
+def graph_cache(maxsize=1000, maxbytes=None):
+    return Cache(maxsize=maxsize, maxbytes=maxbytes, sizeof=graph_size)
+
+_store_locks = {}
+_store_locks_lock = threading.Lock()
+
+def store_lock(store):
+    '''The reader/writer lock shared by every LocalResource on an in-memory
+    store, or None for remote SPARQL stores, which handle their own
+    concurrency.'''
+    if is_remote(store):
+        return None
+    with _store_locks_lock:
+        if id(store) not in _store_locks:
+            _store_locks[id(store)] = (store, RWLock())
+        return _store_locks[id(store)][1]
+
+def _locked(exclusive):
+    def decorator(fn):
+        def wrapper(self, *args, **kwargs):
+            if self.lock is None:
+                return fn(self, *args, **kwargs)
+            self.lock.acquire(exclusive)
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self.lock.release(exclusive)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return decorator
+
+shared = _locked(False)
+exclusive = _locked(True)
+
+class InstanceCounter(object):
+    '''Keeps a running count of instances, adjusted by create and delete,
+    and reconciled against the store at most every reconcile_interval
+    seconds (never, if None) or when reconcile() is called.'''
+    def __init__(self, count, reconcile_interval=None):
+        self._count = count
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._value = None
+        self._reconciled = 0
+
+    def reconcile(self):
+        value = self._count()
+        with self._lock:
+            self._value = value
+            self._reconciled = time.time()
+        return value
+
+    def value(self):
+        if self._value is None or (self.reconcile_interval is not None and
+                                   time.time() - self._reconciled > self.reconcile_interval):
+            return self.reconcile()
+        return self._value
+
+    def add(self, n=1):
+        with self._lock:
+            if self._value is not None:
+                self._value = max(self._value + n, 0)
+
+class SecondaryIndex(object):
+    '''Maps (predicate, value) to the subject that has that value, for
+    inverse-functional predicates.'''
+    def __init__(self):
+        self.predicates = set()
+        self._lock = threading.RLock()
+        self._subjects = {}
+        self._keys = {}
+
+    def add_predicate(self, pred, pairs=()):
+        with self._lock:
+            self.predicates.add(pred)
+            for s, o in pairs:
+                self.put(pred, o, s)
+
+    def get(self, pred, value):
+        return self._subjects.get((pred, value))
+
+    def put(self, pred, value, subject):
+        with self._lock:
+            key = (pred, value)
+            previous = self._subjects.get(key)
+            if previous is not None and previous != subject:
+                self._keys[previous].discard(key)
+            self._subjects[key] = subject
+            self._keys.setdefault(subject, set()).add(key)
+
+    def add(self, triples):
+        for s, p, o in triples:
+            if p in self.predicates:
+                self.put(p, o, s)
+
+    def remove(self, triples):
+        with self._lock:
+            for s, p, o in triples:
+                key = (p, o)
+                if p in self.predicates and self._subjects.get(key) == s:
+                    del self._subjects[key]
+                    self._keys[s].discard(key)
+
+    def discard(self, uri, values=False):
+        '''Drops every entry with uri as its subject and, if values is
+        True, as its value.'''
+        with self._lock:
+            for key in self._keys.pop(uri, ()):
+                self._subjects.pop(key, None)
+            if not values:
+                return
+            for p in self.predicates:
+                subject = self._subjects.pop((p, uri), None)
+                if subject is not None:
+                    self._keys[subject].discard((p, uri))
+
 class LocalResource(object):
-    def __init__(self, cl, prefix, store, vocab, lod_prefix, mixin=object, name=None):
+    def __init__(self, cl, prefix, store, vocab, lod_prefix, mixin=object, name=None,
+                 chunk_size=100, read_cache=None, count_reconcile_interval=300,
+                 lock=False, writer=None, schema_cache=None, lazy=False,
+                 predicate_groups=None, response_cache=None):
         self.inputClass = cl
         self.store = store
         self.vocab = vocab
         self.lod_prefix = lod_prefix
         self.prefix = prefix
         self.clResource = self.vocab.resource(cl)
-        self.view_template = list(self.clResource[flaskld.hasView])
+        if schema_cache is not None:
+            self.schema = schema_cache.get(vocab, cl)
+        else:
+            self.schema = compile_schema(vocab, cl)
+        self.view_template = self.schema.view_templates
         self.prefix = prefix
         self.service_prefix = self.lod_prefix + '/' + prefix
         if not self.service_prefix.endswith('/'):
@@ -117,8 +445,37 @@ class LocalResource(object):
         self.name = name
         if name is None:
             self.name = prefix
-
-        self.alchemy = create_model(self,mixin)
+        self.chunk_size = chunk_size
+        self.read_cache = read_cache
+        # serialized responses, keyed by (URI, version tag, mimetype); pass
+        # a Cache with maxbytes and sizeof=len to bound it by size
+        self.response_cache = response_cache
+        self._invalidation_callbacks = []
+        self._generation = 0
+        self._cache_lock = threading.Lock()
+        self.counter = InstanceCounter(self._count, count_reconcile_interval)
+        # By default, share one lock per in-memory store; pass lock=None to
+        # disable locking or any RWLock-compatible object to replace it.
+        if lock is False:
+            lock = store_lock(store)
+        self.lock = lock
+        if writer is None:
+            writer = BatchWriter(store)
+        self.writer = writer
+        # In lazy mode, model attributes are fetched one predicate at a time,
+        # or together with the other predicates of their group.
+        self.predicate_groups = {}
+        for group in predicate_groups or []:
+            group = tuple(URIRef(p) for p in group)
+            for p in group:
+                self.predicate_groups[p] = group
+
+        self.index = SecondaryIndex()
+        for field in self.schema.fields:
+            if field.inverse_functional:
+                self.add_index(field.identifier)
+
+        self.alchemy = create_model(self,mixin,lazy=lazy)
 
     def add_api(self, api):
         me = self
@@ -136,12 +493,75 @@ class LocalResource(object):
         api.add_resource(LDResource, '/'+self.prefix+'/<string:ident>',
                          endpoint=str(self.prefix+"linkeddataresource"))
 
+    def on_invalidate(self, callback):
+        '''Registers callback(uri), called for each URI a write touches.'''
+        self._invalidation_callbacks.append(callback)
+
+    def invalidate(self, *uris):
+        with self._cache_lock:
+            self._generation += 1
+            if self.read_cache is not None:
+                for uri in uris:
+                    self.read_cache.invalidate(URIRef(uri))
+        invalidate_choices(self.inputClass)
+        for callback in self._invalidation_callbacks:
+            for uri in uris:
+                callback(URIRef(uri))
+        if self.response_cache is not None and uris:
+            uris = set(str(uri) for uri in uris)
+            self.response_cache.invalidate_if(lambda key, value: key[0] in uris)
+
+    @shared
+    def add_index(self, pred):
+        '''Index pred, which must be inverse-functional, for get_by.'''
+        pred = URIRef(pred)
+        self.index.add_predicate(pred, ConjunctiveGraph(self.store).subject_objects(pred))
+
+    @shared
+    def _lookup(self, pred, value):
+        return ConjunctiveGraph(self.store).value(None, pred, value)
+
+    @shared
+    def _confirm(self, uri, pred, value):
+        return (uri, pred, value) in ConjunctiveGraph(self.store)
+
+    def lookup(self, pred, value):
+        '''The subject that has value for pred. Indexed predicates are
+        answered from the index, which is complete after startup, so a miss
+        means there is no such subject; a hit is confirmed against the store
+        in case another process has changed it. Other predicates are looked
+        up in the store.'''
+        if pred not in self.index.predicates:
+            return self._lookup(pred, value)
+        uri = self.index.get(pred, value)
+        if uri is None:
+            return None
+        if not self._confirm(uri, pred, value):
+            self.index.remove([(uri, pred, value)])
+            return None
+        return uri
+
+    def _new_ident(self, inputGraph, i):
+        if self.schema.key is not None:
+            return slugify(inputGraph.value(i, self.schema.key))
+        return create_id()
+
+    def _metadata(self, uri, ident):
+        now = datetime.now()
+        result = [(uri,dc.identifier,Literal(ident)),
+                  (uri,RDF.type,self.inputClass)]
+        if session and 'user_id' in session and session['user_id'] is not None:
+            result.append((uri, flaskld.hasOwner, URIRef(session['user_id'])))
+        result.append((uri, flaskld.hasDate, Literal(now.strftime("%Y-%m-%d-%H-%M-%S"))))
+        result.append((uri, dc.created, Literal(now)))
+        result.append((uri, dc.modified, Literal(datetime.utcnow())))
+        return result
+
+    @exclusive
     def create(self,inputGraph):
         outputGraph = Graph()
         i = URIRef("#")
-        ident = create_id()
-        if self.clResource.value(flaskld.key):
-            ident = slugify(inputGraph.value(i, self.clResource.value(flaskld.key).identifier))
+        ident = self._new_ident(inputGraph, i)
         uri = self.service_prefix+str(ident)
         def rebase(triples):
             def replace(x):
@@ -154,92 +574,336 @@ class LocalResource(object):
             for t in triples:
                 yield (replace(t[0]),replace(t[1]),replace(t[2]))
         idb = Graph(self.store,URIRef(uri))
+        existed = False
+        if self.schema.key is not None:
+            existed = (URIRef(uri),RDF.type,self.inputClass) in idb
         idb.remove((None,None,None))
-        idb += rebase(inputGraph)
-        idb.add((URIRef(uri),dc.identifier,Literal(ident)))
-        idb.add((URIRef(uri),RDF.type,self.inputClass))
-        if session and 'user_id' in session and session['user_id'] is not None:
-            idb.add((URIRef(uri), flaskld.hasOwner, URIRef(session['user_id'])))
-        idb.add((URIRef(uri), flaskld.hasDate, Literal(datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))))
-        idb.add((URIRef(uri), dc.created, Literal(datetime.now())))
-        idb.commit()
+        self.index.discard(URIRef(uri))
+        triples = list(rebase(inputGraph)) + self._metadata(URIRef(uri), ident)
+        self.writer.write(uri, triples)
+        self.index.add(triples)
+        self.invalidate(uri)
+        if not existed:
+            self.counter.add(1)
         outputGraph.add((i,OWL.sameAs,URIRef(uri)))
         outputGraph += idb
         outputGraph.template = None
         return outputGraph
 
+    @exclusive
+    def create_many(self, inputGraph):
+        '''Create one resource for each named graph in inputGraph, written
+        together through the resource's BatchWriter as a single batch (one
+        update request on remote stores). The graph's name is a placeholder for the resource's
+        URI: it, and any URI that starts with it, is rebased onto the new
+        URI wherever it appears in the document. Triples in the default
+        graph go to the resource whose placeholder is their subject.
+        Returns a graph linking each placeholder to its new URI with
+        owl:sameAs.'''
+        default = inputGraph.default_context.identifier
+        placeholders = [c.identifier for c in inputGraph.contexts()
+                        if c.identifier != default]
+        mapping = {}
+        graphs = {}
+        quads = []
+        for placeholder in placeholders:
+            context = inputGraph.get_context(placeholder)
+            ident = self._new_ident(context, placeholder)
+            uri = URIRef(self.service_prefix+str(ident))
+            if uri in graphs:
+                raise ValueError("Duplicate identifier %s in bulk document." % ident)
+            mapping[placeholder] = uri
+            graphs[uri] = idb = Graph(self.store,uri)
+            quads.extend((s, p, o, uri) for s, p, o in self._metadata(uri, ident))
+        prefixes = sorted(mapping, key=len, reverse=True)
+        def replace(x):
+            if isinstance(x,URIRef):
+                for placeholder in prefixes:
+                    if x == placeholder:
+                        return mapping[placeholder]
+                    elif x.startswith(placeholder):
+                        return URIRef(mapping[placeholder] + x[len(placeholder):])
+            return x
+        for s, p, o, c in inputGraph.quads((None,None,None)):
+            target = c.identifier
+            if target == default:
+                if s not in mapping:
+                    raise ValueError("Triple about %s is not in any resource's graph." % s)
+                target = s
+            quads.append((replace(s), replace(p), replace(o), mapping[target]))
+        created = len(graphs)
+        # Keyed resources that already exist are replaced. On remote stores
+        # the graphs are dropped in the same request that writes the
+        # document, so the whole bulk create succeeds or fails at once.
+        replaced = []
+        if self.schema.key is not None:
+            for uri, idb in graphs.items():
+                if (uri,RDF.type,self.inputClass) in idb:
+                    created -= 1
+                replaced.append(uri)
+        prefix = None
+        if is_remote(self.store):
+            prefix = ['DROP SILENT GRAPH %s' % uri.n3() for uri in replaced]
+        else:
+            for uri in replaced:
+                graphs[uri].remove((None,None,None))
+        for uri in replaced:
+            self.index.discard(uri)
+        self.writer.write_quads(quads, prefix, batch_size=None)
+        self.index.add(quad[:3] for quad in quads)
+        self.invalidate(*mapping.values())
+        self.counter.add(created)
+        outputGraph = Graph()
+        for placeholder, uri in mapping.items():
+            outputGraph.add((placeholder,OWL.sameAs,uri))
+        outputGraph.template = None
+        return outputGraph
+
+    @shared
+    def modified(self, uri):
+        value = Graph(self.store,uri).value(uri, dc.modified)
+        if value is None:
+            return None
+        value = value.toPython()
+        if not isinstance(value, datetime):
+            return None
+        return value
+
+    @shared
     def read(self, uri):
-        db = ConjunctiveGraph(self.store)
-        idb = Graph(self.store,uri) 
         result = Graph(identifier=uri)
-        # raise RuntimeError(result)
-        result += idb
-        describe(db.store, uri, result)
+        cached = None
+        if self.read_cache is not None:
+            cached = self.read_cache.get(uri)
+        if cached is not None:
+            result += cached
+        else:
+            generation = self._generation
+            db = ConjunctiveGraph(self.store)
+            idb = Graph(self.store,uri)
+            result += idb
+            describe(db.store, uri, result)
+            if self.read_cache is not None:
+                # a write since the read began may have changed what we read
+                with self._cache_lock:
+                    if generation == self._generation:
+                        self.read_cache.put(uri, tuple(result))
         result.template = None
         if len(self.view_template) > 0:
-            result.template = self.view_template[0].value
+            result.template = self.view_template[0]
         return result
 
+    _read_many_query = Template('''
+        select ?r ?s ?p ?o where {
+            values ?r { {% for uri in uris %}{{uri.n3()}} {% endfor %}}
+            { ?r ?p ?o. bind(?r as ?s) }
+            union { ?r ?rp ?s. filter(isBlank(?s)) ?s ?p ?o }
+            union { graph ?r { ?s ?p ?o } }
+        }''')
+
+    @shared
+    def read_many(self, uris):
+        '''What read() gives for each of uris, in one query per chunk_size
+        resources (with blank nodes described one level deep, as in
+        describe_many). Returns a graph per URI.'''
+        result = OrderedDict((URIRef(uri), Graph(identifier=uri)) for uri in uris)
+        missing = []
+        for uri, graph in result.items():
+            cached = None
+            if self.read_cache is not None:
+                cached = self.read_cache.get(uri)
+            if cached is not None:
+                graph += cached
+            else:
+                missing.append(uri)
+        db = ConjunctiveGraph(self.store)
+        for i in range(0, len(missing), self.chunk_size):
+            query = self._read_many_query.render(uris=missing[i:i+self.chunk_size])
+            for r, s, p, o in db.query(query):
+                result[r].add((s, p, o))
+        for graph in result.values():
+            graph.template = None
+            if len(self.view_template) > 0:
+                graph.template = self.view_template[0]
+        return result
+
+    @exclusive
     def update(self,inputGraph, uri):
-        allGraphs = ConjunctiveGraph(self.store)
-        allGraphs.remove((uri,None,None))
+        uri = URIRef(uri)
         idb = Graph(self.store,uri)
-        idb.remove((None,None,None))
-        idb += inputGraph
+        target = Graph(identifier=uri)
+        target += (t for t in inputGraph if t[0] != uri or t[1] != dc.modified)
+        target.add((uri, dc.modified, Literal(datetime.utcnow())))
+        others = set(c.identifier for s, p, o, c in
+                     ConjunctiveGraph(self.store).quads((uri,None,None))
+                     if c.identifier != uri)
+        foreign = len(others) > 0
+        removals, additions, blank = graph_delta(idb, target)
+        self.writer.apply_delta(uri, removals, additions, blank, foreign)
+        # the triples removed from other graphs change those resources too
+        self._touch(others)
+        if foreign:
+            self.index.discard(uri)
+            self.index.add(target)
+        else:
+            self.index.remove(removals)
+            self.index.add(additions)
+        self.invalidate(uri, *others)
         idb.template = None
-        self.store.commit()
         return idb
 
+    @exclusive
     def delete(self,uri):
-        idb = Graph(self.store,uri)
-        if len(idb) == 0:
+        uri = URIRef(uri)
+        if not self.writer.graph_exists(uri):
             abort(404, "Resource does not exist or is not deletable.")
-        idb.remove((None,None,None))
         g = ConjunctiveGraph(self.store)
-        g.remove((uri,None,None))
-        g.remove((None,None,uri))
+        typed = (uri,RDF.type,self.inputClass) in g
+        # Resources whose descriptions change with the cascade: those that
+        # refer to uri, and those whose graphs hold triples about it.
+        affected = set(s for s, p, o, c in g.quads((None,None,uri)))
+        affected.update(c.identifier for s, p, o, c in g.quads((None,None,uri)))
+        affected.update(c.identifier for s, p, o, c in g.quads((uri,None,None)))
+        affected = set(a for a in affected if isinstance(a, URIRef) and a != uri)
+        self.writer.delete_resource(uri)
+        self._touch(affected)
+        self.index.discard(uri, values=True)
+        self.invalidate(uri, *affected)
+        if typed:
+            self.counter.add(-1)
+
+    def _touch(self, uris):
+        '''Bumps dc:modified on uris, so that their version tags change.'''
+        self.writer.touch(uris, dc.modified, Literal(datetime.utcnow()))
 
     def count(self):
+        return self.counter.value()
+
+    def reconcile_count(self):
+        return self.counter.reconcile()
+
+    @shared
+    def _count(self):
         db = ConjunctiveGraph(self.store)
         query = '''select (count(?s) as ?count) where { ?s a %s }''' % self.inputClass.n3()
-        result = list(db.query(query))[0][0].value
+        result = list(run_query(db, query))[0][0].value
         return result
 
 
     _list_query_template = Template('''
-        select ?instance where {
+        select ?instance ?sortval where {
             ?instance a {{inputClass.n3()}};
             {% if sort_column != None %}
               {{sort_column.n3()}} ?sortval;
             {% endif %}
             .
+            {% if after %}{{after}}{% endif %}
         }
-        {% if sort_column != None %} ORDER BY  
-          {% if sort_desc %}DESC(?sortval){% else %}?sortval{% endif %}
-        {% endif %}
-        OFFSET {{offset}}
-        {% if limit != None %} LIMIT {{limit}} {% endif %}''')
+        {% if sort_column != None or keyset %} ORDER BY
+          {% if sort_column != None %}
+            {% if sort_desc %}DESC(?sortval){% else %}?sortval{% endif %}
+          {% endif %}
+          {% if keyset %}
+            {% if sort_desc %}DESC(?instance){% else %}?instance{% endif %}
+          {% endif %}
+        {% endif %}''')
+
+    @shared
+    def _list_rows(self, offset=0, limit=None, sort_column=None, sort_desc=False,
+                   after=None, keyset=False):
+        keys = ['instance']
+        if sort_column is not None:
+            keys = ['sortval', 'instance']
+        db = ConjunctiveGraph(self.store)
+        bindings = {}
+        cursor_filter = None
+        if after is not None:
+            if len(after) != len(keys):
+                raise ValueError("Pagination cursor does not match this listing.")
+            inline = is_remote(self.store)
+            cursor_filter = _keyset_filter(keys, after, sort_desc, inline)
+            if not inline:
+                bindings = _keyset_bindings(keys, after)
+        query = self._list_query_template.render(inputClass=self.inputClass,
+                                                 sort_column=sort_column, sort_desc=sort_desc,
+                                                 after=cursor_filter, keyset=keyset)
+        return keys, list(run_query(db, query, bindings, offset, limit))
 
     def list_resources(self, offset=0, limit=None, sort_column=None, sort_desc=False):
-        query = self._list_query_template.render(inputClass=self.inputClass, limit=limit, offset=offset, 
-                                                 sort_column=sort_column, sort_desc=sort_desc)
-        db = ConjunctiveGraph(self.store)
-        results = db.query(query)
-        for row in results:
+        keys, rows = self._list_rows(offset, limit, sort_column, sort_desc)
+        for row in rows:
             yield row[0]
 
+    def page_resources(self, limit, sort_column=None, sort_desc=False, after=None, offset=0):
+        '''Keyset pagination: returns the instances following the position
+        encoded in the cursor `after`, and the cursor for the next page (or
+        None on the last page).'''
+        if after is not None:
+            after = decode_cursor(after)
+        keys, rows = self._list_rows(offset, limit, sort_column, sort_desc, after, keyset=True)
+        cursor = None
+        if limit is not None and len(rows) == limit:
+            last = rows[-1]
+            cursor = encode_cursor([last[1] if k == 'sortval' else last[0] for k in keys])
+        return [row[0] for row in rows], cursor
+
+    _project_query = Template('''
+        select ?s ?p ?o where {
+            values ?s { {% for uri in uris %}{{uri.n3()}} {% endfor %}}
+            values ?p { {% for p in predicates %}{{p.n3()}} {% endfor %}}
+            ?s ?p ?o
+        }''')
+
+    @shared
+    def project(self, uris, predicates):
+        '''Fetch just the given predicates for each of uris, in one query per
+        chunk_size resources. Returns a graph per URI.'''
+        result = OrderedDict((URIRef(uri), Graph(identifier=uri)) for uri in uris)
+        db = ConjunctiveGraph(self.store)
+        uris = list(result)
+        predicates = list(predicates)
+        for i in range(0, len(uris), self.chunk_size):
+            query = self._project_query.render(uris=uris[i:i+self.chunk_size],
+                                               predicates=predicates)
+            for s, p, o in db.query(query):
+                result[s].add((s, p, o))
+        return result
 
+    @shared
     def list(self, offset=0, limit=None, sort_column=None, sort_desc=False):
-        db = ConjunctiveGraph(self.store)
         g = Graph()
-
-        for instance in self.list_resources(offset, limit, sort_column, sort_desc):
-            describe(instance,db,g)
-            idb = Graph(self.store,instance)
-            describe(instance,idb,g)
+        instances = self.list_resources(offset, limit, sort_column, sort_desc)
+        describe_many(self.store, instances, g, self.chunk_size)
         g.template = None
         return g
 
+    @shared
+    def _describe(self, instances):
+        g = Graph()
+        describe_many(self.store, instances, g, self.chunk_size)
+        return g
+
+    def iter_list(self, sort_column=None, sort_desc=False):
+        '''Yields the graph list() gives, chunk_size resources at a time,
+        following keyset cursors, so that the whole list is never held in
+        memory.'''
+        cursor = None
+        while True:
+            instances, cursor = self.page_resources(self.chunk_size, sort_column,
+                                                    sort_desc, cursor)
+            if instances:
+                yield self._describe(instances)
+            if cursor is None:
+                break
+
+    @shared
+    def page(self, limit, sort_column=None, sort_desc=False, after=None, offset=0):
+        g = Graph()
+        instances, cursor = self.page_resources(limit, sort_column, sort_desc, after, offset)
+        describe_many(self.store, instances, g, self.chunk_size)
+        g.template = None
+        return g, cursor
+
 
 _mapper_classes = {}
 
@@ -257,22 +921,63 @@ class rdfAbstract(object):
                 log.warn(
                     "Descriptor %s has range of: %s but not yet mapped" % (
                         self, self.range_type))
-                return rdfSubject
+                return rdfalchemy.rdfSubject
         else:
-            return rdfSubject
+            return rdfalchemy.rdfSubject
+
+    def _graph(self, obj):
+        """
+        The graph to read this descriptor's values from: whatever the
+        instance has loaded for the predicate, or else its full description.
+        """
+        graph_for = getattr(obj, '_graph_for', None)
+        if graph_for is not None:
+            return graph_for(self.pred)
+        return obj.db
+
+    def _value(self, val):
+        if isinstance(val, Literal):
+            return val.toPython()
+        elif isinstance(val, (BNode, URIRef)):
+            return self.range_class(val)
+        return val
 
 class rdfSingle(rdfAbstract, rdfalchemy.rdfSingle):
-    pass
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        if self.name in obj.__dict__:
+            return obj.__dict__[self.name]
+        val = self._graph(obj).value(obj.resUri, self.pred)
+        if val is not None:
+            val = self._value(val)
+        obj.__dict__[self.name] = val
+        return val
 
 class rdfMultiple(rdfAbstract, rdfalchemy.rdfMultiple):
-    pass
-
-def create_model(local_api, mixin=object):
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        if self.name in obj.__dict__:
+            return obj.__dict__[self.name]
+        db = self._graph(obj)
+        val = list(db.objects(obj.resUri, self.pred))
+        # return a Collection as a list of its members
+        if len(val) == 1 and not isinstance(val[0], Literal) and db.value(val[0], RDF.first):
+            val = list(Collection(db, val[0]))
+        val = [self._value(v) for v in val]
+        obj.__dict__[self.name] = val
+        return val
+
+def create_model(local_api, mixin=object, lazy=False):
     class Resource(rdfalchemy.rdfSubject, mixin):
 
         _sortable_columns = {}
 
         _db = None
+        _loaded = None
+        _loaded_predicates = frozenset()
+
         @property 
         def db(self):
             if self._db == None:
@@ -287,19 +992,57 @@ def create_model(local_api, mixin=object):
             self.local_api = local_api
             self.resUri = URIRef(uri)
             mixin.__init__(self)
-            self.db
+            if not lazy:
+                self.db
             #print kwargs
             if kwargs:
                 self._set_with_dict(kwargs)
             #rdfalchemy.rdfSubject.__init__(self,self.resUri, **kwargs)
 
+        @classmethod
+        def from_description(cls, uri, graph):
+            """
+            An instance over a description already read, as by
+            LocalResource.read or read_many.
+            """
+            obj = cls.from_graph(uri, graph, ())
+            obj._db = graph
+            return obj
+
+        @classmethod
+        def from_graph(cls, uri, graph, predicates):
+            """
+            A lightweight instance whose values for predicates come from
+            graph; anything else loads the full description through db.
+            """
+            obj = cls.__new__(cls)
+            obj.local_api = local_api
+            obj.resUri = URIRef(uri)
+            mixin.__init__(obj)
+            obj._loaded = graph
+            obj._loaded_predicates = frozenset(predicates)
+            return obj
+
+        def _graph_for(self, pred):
+            if pred in self._loaded_predicates:
+                return self._loaded
+            if not lazy or self._db is not None or self.resUri == URIRef("#"):
+                return self.db
+            group = local_api.predicate_groups.get(pred, (pred,))
+            loaded = local_api.project([self.resUri], group)[self.resUri]
+            if self._loaded is not None:
+                loaded += self._loaded
+            self._loaded = loaded
+            self._loaded_predicates = self._loaded_predicates.union(group)
+            return self._loaded
+
         @property
         def id(self):
             return self.resUri
 
         def __str__(self):
             #print self.resUri, self.local_api
-            return get_label(self._db.resource(self.resUri))
+            return get_label(self._graph_for(RDFS.label).resource(self.resUri))
         
         @classmethod
         def get_by(cls, **kwargs):
@@ -314,7 +1057,8 @@ def create_model(local_api, mixin=object):
 
             :Note:
             the keyword should map to an rdf predicate
-            that is of type owl:InverseFunctional"""
+            that is of type owl:InverseFunctional, or one registered
+            with LocalResource.add_index, to be answered from the index"""
             if len(kwargs) != 1:
                 raise ValueError("get_by wanted exactly 1 but got  %i args\n" +
                                  "Maybe you wanted filter_by" % (len(kwargs)))
@@ -324,8 +1068,7 @@ def create_model(local_api, mixin=object):
             else:
                 o = Literal(value)
             pred = cls._getdescriptor(key).pred
-            g = ConjunctiveGraph(local_api.store)
-            uri = g.value(None, pred, o)
+            uri = local_api.lookup(pred, o)
             if uri:
                 return cls(uri)
             else:
@@ -335,37 +1078,21 @@ def create_model(local_api, mixin=object):
             return hasattr(other,'id') and self.id == other.id
 
     if len(local_api.view_template) > 0:
-        Resource.template = local_api.view_template[0].value
+        Resource.template = local_api.view_template[0]
     Resource.__name__ = str(local_api.name)
     Resource.type = rdfMultiple(RDF.type,range_type=OWL.Class)
     Resource.rdf_type = local_api.inputClass
     Resource.clResource = local_api.clResource
+    Resource.schema = local_api.schema
     Resource._local_api = local_api
-    #fields = [local_api.vocab.resource(x) for x, in local_api.vocab.query('''
-    #    select ?field where {
-    #      ?c rdfs:subClassOf* ?super.
-    #      ?super flaskld:hasField ?field
-    #    } order by ?field
-    #    ''',initNs=dict(flaskld=flaskld), initBindings=dict(c=local_api.clResource.identifier))]
-    #print Resource.rdf_type, list(local_api.clResource[flaskld.hasField])
-    for field in local_api.clResource[flaskld.hasField]:
-        propertyName = field.value(flaskld.fieldName)
-        #print Resource.clResource.identifier, field
-        if propertyName == None:
-            propertyName = local_api.vocab.qname(field.identifier).split(":")[1].replace("-","_")
+    for field in local_api.schema.fields:
+        if field.functional:
+            fieldDescriptor = rdfSingle(field.identifier,range_type=field.range)
         else:
-            propertyName = propertyName.value
-        propRange = field.value(RDFS.range)
-        if propRange != None:
-            propRange = propRange.identifier
-        if field[RDF.type:OWL.FunctionalProperty]:
-            fieldDescriptor = rdfSingle(field.identifier,range_type=propRange)
-        else:
-            fieldDescriptor = rdfMultiple(field.identifier,range_type=propRange)
-        setattr(Resource, propertyName,fieldDescriptor)
-        if not Resource.clResource[flaskld.hideField:field.identifier]:
-            Resource._sortable_columns[propertyName] = field
-        #print local_api.inputClass, propertyName, field.identifier, Resource.__name__
+            fieldDescriptor = rdfMultiple(field.identifier,range_type=field.range)
+        setattr(Resource, field.name,fieldDescriptor)
+        if not field.hidden:
+            Resource._sortable_columns[field.name] = field
     _mapper_classes[local_api.inputClass] = Resource
     return Resource
 
@@ -375,14 +1102,14 @@ class ModelView(BaseModelView):
 
     def __init__(self, local_api, default_sort=None, **kwargs):
         self.local_api = local_api
-        label = local_api.clResource.value(RDFS.label)
+        label = local_api.schema.label
         if default_sort != None:
             self._default_sort = default_sort
-        if (label == None):
-            label = re.sub(":_-\/"," ",re.sub("^([^:])+:","",
-                           local_api.clResource.graph.qname(local_api.clResource.identifier)))
-        else:
-            label = label.value
+        # Cursors for the end of each page seen so far, so that paging forward
+        # can use keyset pagination instead of OFFSET.
+        self._cursors = Cache(maxsize=1000)
+        # any write can shift rows between pages
+        local_api.on_invalidate(lambda uri: self._cursors.clear())
         BaseModelView.__init__(self, local_api.alchemy,  name=label, **kwargs)
 
     def get_pk_value(self, model):
@@ -473,7 +1200,10 @@ class ModelView(BaseModelView):
             :param id:
                 Model id
         """
-        return self.local_api.alchemy(URIRef(id))
+        model = self.local_api.alchemy(URIRef(id))
+        # the edit and details views read every field, so load them at once
+        model.db
+        return model
 
     def get_count(self):
         return self.local_api.count()
@@ -525,11 +1255,25 @@ class ModelView(BaseModelView):
         else:
             sort_field = self._get_default_order()
 
-        instances = self.local_api.list_resources(offset, limit, sort_field, sort_desc)
+        cursor_key = (sort_field, sort_desc)
+        after = self._cursors.get(cursor_key + (page - 1,)) if page > 0 else None
+        if after is not None:
+            offset = 0
+        instances, cursor = self.local_api.page_resources(limit, sort_field, sort_desc,
+                                                          after, offset)
+        if cursor is not None:
+            self._cursors.put(cursor_key + (page,), cursor)
+
+        model = self.local_api.alchemy
+        predicates = [model._sortable_columns[c].identifier
+                      for c in self.scaffold_list_columns()
+                      if c in model._sortable_columns]
+        predicates.append(RDFS.label)
+        graphs = self.local_api.project(instances, predicates)
 
         def gen():
-            for i in instances:
-                yield self.get_one(i)
+            for uri, graph in graphs.items():
+                yield model.from_graph(uri, graph, predicates)
 
         return count, gen()
 
@@ -9,17 +9,69 @@ from flask_admin.model.fields import InlineFieldList, AjaxSelectField, AjaxSelec
 from flask_admin.model.widgets import InlineFormWidget
 from flask_admin._compat import iteritems
 
+from .utils import Cache
+from .schema import qname_label
+
 import rdfalchemy
-import re
 
 dc = Namespace("http://purl.org/dc/terms/")
 
 def get_label(r):
     label = r.label()
     if label == None or len(label) == 0:
-        label = re.sub(":_-\/"," ",re.sub("^([^:])+:","",r.graph.qname(r.identifier)))
+        label = qname_label(r.graph, r.identifier)
     return label
 
+class Choices(object):
+    def __init__(self, choices, classes):
+        self.choices = choices
+        self.index = set(uri for uri, label in choices)
+        self.labels = dict(choices)
+        self.classes = classes
+
+class ChoiceProvider(object):
+    '''Loads the (URI, label) choices for relation fields with one query
+    per range and caches them until an instance of a class in that range is
+    created, updated or deleted (see invalidate).'''
+    def __init__(self, maxsize=100):
+        self.cache = Cache(maxsize=maxsize)
+
+    def load(self, graph, query, bindings, classes=None):
+        '''classes, if given, is called on a cache miss to get the set of
+        classes whose instances appear in the choices; None means any class.'''
+        key = (query, tuple(sorted(bindings.items())), id(graph.store))
+        entry = self.cache.get(key)
+        if entry is None:
+            choices = []
+            seen = set()
+            for value, label in graph.query(query, initBindings=bindings):
+                if value in seen:
+                    continue
+                seen.add(value)
+                if label is None or len(label) == 0:
+                    label = qname_label(graph, value)
+                choices.append((value, str(label)))
+            entry = Choices(choices, classes() if classes is not None else None)
+            self.cache.put(key, entry)
+        return entry
+
+    def invalidate(self, cl):
+        return self.cache.invalidate_if(
+            lambda key, entry: entry.classes is None or cl in entry.classes)
+
+choice_provider = ChoiceProvider()
+
+def invalidate_choices(cl):
+    return choice_provider.invalidate(cl)
+
+def relation_choices(provider, rel, range, graph, query):
+    bindings = dict(rel=rel)
+    classes = None
+    if range is not None:
+        bindings['range'] = range
+        classes = lambda: set(graph.transitive_subjects(RDFS.subClassOf, range))
+    return provider.load(graph, query, bindings, classes)
+
 
 
 class RelationField(fields.SelectMultipleField):
@@ -35,29 +87,31 @@ class RelationField(fields.SelectMultipleField):
         else:
             self.data = []
 
-    choice_query = '''select ?id where { ?id a [rdfs:subClassOf* ?range].
+    choice_query = '''select ?id ?label where { ?id a [rdfs:subClassOf* ?range].
+    optional { ?id rdfs:label ?label }
     } order by ?id'''
-    
+
+    def get_choices(self):
+        return relation_choices(self.choice_provider, self.rel, self.range,
+                                self.choice_graph, self.choice_query)
+
     def iter_choices(self):
-        range = self.rel.value(RDFS.range)
-        bindings = dict(rel=self.rel.identifier)
-        if range is not None:
-            bindings['range'] = range.identifier
-        for value,  in self.choice_graph.query(self.choice_query, initBindings=bindings):
-            selected = self.coerce(value) in self.data
-            label = get_label(self.choice_graph.resource(value))
-            yield (value, label, selected)
+        selected = set(self.coerce(d) for d in self.data or [])
+        for value, label in self.get_choices().choices:
+            yield (value, label, value in selected)
 
     def pre_validate(self, form):
         if self.data:
-            values = list(c[0] for c in self.iter_choices())
+            index = self.get_choices().index
             for d in self.data:
-                if d not in values:
+                if d not in index:
                     raise ValueError(self.gettext("'%(value)s' is not a valid choice for this field") % dict(value=d))
             
-    def __init__(self, rel, choice_graph, **kwargs):
-        self.rel = rel
+    def __init__(self, rel, choice_graph, range=None, provider=None, **kwargs):
+        self.rel = URIRef(rel)
+        self.range = range
         self.choice_graph = choice_graph
+        self.choice_provider = provider or choice_provider
         fields.SelectMultipleField.__init__(self, coerce=URIRef, **kwargs)
 
 class TypeField(RelationField):
@@ -70,13 +124,20 @@ class TypeField(RelationField):
     widget = widgets.ListWidget(prefix_label=False)
     option_widget = widgets.CheckboxInput()
 
-    choice_query = '''select ?id where { ?id rdfs:subClassOf* ?rel. } order by ?id'''        
+    choice_query = '''select ?id ?label where { ?id rdfs:subClassOf* ?rel.
+    optional { ?id rdfs:label ?label }
+    } order by ?id'''
+
+    def get_choices(self):
+        bindings = dict(rel=self.rel)
+        return self.choice_provider.load(self.choice_graph, self.choice_query, bindings,
+                                         lambda: set())
 
     def process_data(self,value):
         if value != None:
             self.data = [v.resUri for v in value]
         else:
-            self.data = [self.rel.identifier]
+            self.data = [self.rel]
 
 mappings = {
     None: fields.TextField,
@@ -89,24 +150,17 @@ mappings = {
 }
 
 def get_field(model, p, field_name, field_args=None):
+    """
+    Create a form field from a compiled field schema (see
+    flask_ld.schema.FieldSchema).
+    """
     if field_args == None: field_args = {}
-    label = p.value(RDFS.label)
-    if (label == None):
-        label = re.sub(":_-\/"," ",re.sub("^([^:])+:","",p.graph.qname(p.identifier)))
-    else:
-        label = label.value
-    description = p.value(dc.description)
-    if description != None:
-        description = description.value
-    f = p.value(RDFS.range)
-    if f != None:
-        f = f.identifier
-    #print field_name, f
-    if p[RDF.type:OWL.ObjectProperty] and f:
-        return RelationField(label=label, id=str(field_name),
-                             rel=p, choice_graph=ConjunctiveGraph(model._local_api.store), **field_args)
+    f = p.range
+    if p.object_property and f:
+        return RelationField(label=p.label, id=str(field_name), rel=p.identifier, range=f,
+                             choice_graph=ConjunctiveGraph(model._local_api.store), **field_args)
     if f in mappings:
-        return mappings[f](label=label,description=description, id=str(field_name), **field_args)
+        return mappings[f](label=p.label,description=p.description, id=str(field_name), **field_args)
     else:
         return None
 
@@ -168,7 +222,7 @@ def get_form(model,
         properties = (p for p in properties if p[0] not in exclude)
 
     # Create fields
-    field_dict = {"type":TypeField(rel=model.clResource, choice_graph=model.clResource.graph)}
+    field_dict = {"type":TypeField(rel=model.schema.identifier, choice_graph=model._local_api.vocab)}
     for name, p in properties:
         field = get_field(model, p, name, field_args.get(name))
         if field is not None:
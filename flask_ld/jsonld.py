@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from builtins import str
+from builtins import object
+import json
+from rdflib import ConjunctiveGraph, URIRef, Literal, RDF, XSD
+
+# xsd:double is left typed: an integral double such as 2.0 would read
+# back as xsd:integer
+native_types = (XSD.boolean, XSD.integer)
+
+class Context(object):
+    '''A JSON-LD @context made of namespace prefixes, built once and reused
+    for every response.'''
+    def __init__(self, namespaces):
+        self.terms = dict((prefix, str(ns)) for prefix, ns in namespaces if prefix)
+        self._namespaces = sorted(((ns, prefix) for prefix, ns in self.terms.items()),
+                                  key=lambda x: len(x[0]), reverse=True)
+
+    def compact(self, iri):
+        for ns, prefix in self._namespaces:
+            if iri.startswith(ns) and len(iri) > len(ns):
+                suffix = iri[len(ns):]
+                if not suffix.startswith('//'):
+                    return prefix + ':' + suffix
+        return str(iri)
+
+def build_context(graph):
+    return Context(graph.namespace_manager.namespaces())
+
+def _literal(literal, context):
+    if literal.language:
+        return {'@value': str(literal), '@language': literal.language}
+    if literal.datatype is None or literal.datatype == XSD.string:
+        return str(literal)
+    if literal.datatype in native_types:
+        value = literal.toPython()
+        if isinstance(value, (bool, int)):
+            return value
+    return {'@value': str(literal), '@type': context.compact(literal.datatype)}
+
+def write_jsonld(graph, context):
+    '''Writes graph as compact JSON-LD without going through the generic
+    compaction algorithm. Only handles the flat shape of a single resource:
+    one subject IRI whose objects are all IRIs or literals. Returns None for
+    any other graph.'''
+    if isinstance(graph, ConjunctiveGraph) or len(graph) == 0:
+        return None
+    subject = None
+    properties = {}
+    for s, p, o in graph:
+        if subject is None:
+            subject = s
+        if s != subject or not isinstance(s, URIRef):
+            return None
+        if p == RDF.type and isinstance(o, URIRef):
+            key = '@type'
+            value = context.compact(o)
+        elif isinstance(o, URIRef):
+            key = context.compact(p)
+            value = {'@id': context.compact(o)}
+        elif isinstance(o, Literal):
+            key = context.compact(p)
+            value = _literal(o, context)
+        else:
+            return None
+        properties.setdefault(key, []).append(value)
+    node = {'@context': context.terms, '@id': context.compact(subject)}
+    for key, values in properties.items():
+        node[key] = values[0] if len(values) == 1 else values
+    return json.dumps(node, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+
+def serialize_jsonld(graph, context=None):
+    '''Compact JSON-LD for graph as utf-8 bytes, using the fast writer when
+    the graph has its shape and rdflib's serializer otherwise. Pass a
+    prebuilt context; without one, it is built from graph's namespaces.'''
+    if context is None:
+        context = build_context(graph)
+    elif isinstance(context, dict):
+        context = Context(context.items())
+    data = write_jsonld(graph, context)
+    if data is None:
+        return graph.serialize(format='json-ld', context=context.terms,
+                               indent=None, separators=(',', ':'))
+    return data.encode('utf-8')
@@ -1,36 +1,153 @@
 from __future__ import print_function
 from builtins import str
 from rdflib import *
-from flask_ld.flaskld import LocalResource
-from flask import Flask, request, make_response, render_template, g, session, abort
+from flask_ld.flaskld import LocalResource, version_tag, next_link
+from flask import Flask, request, make_response, render_template, g, session, abort, Response
+from flask_ld.utils import iter_lines, line_formats
+from flask_ld.jsonld import build_context, serialize_jsonld
+from werkzeug.http import http_date
 from flask_restful import Resource, Api
 import sadi
 
+def negotiated_mimetype(api):
+    '''The representation api will choose for this request.'''
+    if api is None:
+        return None
+    for mediatype in api.mediatypes() + [api.default_mediatype]:
+        if mediatype in api.representations:
+            return mediatype
+    return None
+
 class LinkedDataResourceList(Resource):
+    # the Api this resource is registered with, for content negotiation
+    api = None
+
     def __init__(self, local_resource):
         self.local_resource = local_resource
 
+    bulk_formats = {
+        'application/n-quads': 'nquads',
+        'application/trig': 'trig',
+        'application/ld+json': 'json-ld',
+        'application/json': 'json-ld',
+    }
+
     def post(self):
-        inputGraph = Graph()
         contentType = request.headers['Content-Type']
+        mimetype = contentType.split(';')[0].strip()
+        if 'bulk' in request.args or mimetype in ('application/n-quads', 'application/trig'):
+            return self.post_bulk(mimetype)
+        inputGraph = Graph()
         sadi.deserialize(inputGraph,str(request.data),contentType)
         outputGraph = self.local_resource.create(inputGraph)
         return outputGraph, 201
 
+    def post_bulk(self, mimetype):
+        if mimetype not in self.bulk_formats:
+            abort(415, "Bulk creation requires N-Quads, TriG or JSON-LD.")
+        inputGraph = ConjunctiveGraph()
+        try:
+            inputGraph.parse(data=request.data, format=self.bulk_formats[mimetype],
+                             publicID=request.base_url)
+        except Exception as e:
+            # each rdflib parser raises its own syntax errors
+            abort(400, "Could not parse bulk document: %s" % e)
+        try:
+            outputGraph = self.local_resource.create_many(inputGraph)
+        except ValueError as e:
+            abort(400, str(e))
+        return outputGraph, 201
+
     def get(self):
-        return self.local_resource.list()
+        if not any(arg in request.args for arg in ('limit', 'after', 'offset')):
+            mimetype = negotiated_mimetype(self.api)
+            format = getattr(sadi.contentTypes.get(mimetype), 'outputFormat', None)
+            if format in line_formats:
+                return self.stream(mimetype, format)
+            return self.local_resource.list()
+        try:
+            limit = int(request.args.get('limit', 100))
+            offset = int(request.args.get('offset', 0))
+            if limit < 1 or offset < 0:
+                raise ValueError("limit must be positive and offset non-negative.")
+            graph, cursor = self.local_resource.page(limit, after=request.args.get('after'),
+                                                     offset=offset)
+        except ValueError as e:
+            abort(400, str(e))
+        headers = {}
+        if cursor is not None:
+            headers['Link'] = next_link(cursor)
+        return graph, 200, headers
+
+    def stream(self, mimetype, format):
+        '''Streams the whole list in a line format, describing a chunk of
+        resources at a time.'''
+        def generate():
+            for chunk in self.local_resource.iter_list():
+                for data in iter_lines(chunk, format, stream_chunk_size):
+                    yield data
+        return Response(generate(), 200, mimetype=mimetype)
 
 class LinkedDataResource(Resource):
+    # the Api this resource is registered with, for content negotiation
+    api = None
+
     def __init__(self, local_resource):
         self.local_resource = local_resource
 
     def _get_uri(self,ident):
         return URIRef(self.local_resource.prefix + ident)
 
+    def _not_modified(self, etag, modified):
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        since = request.if_modified_since
+        if since is not None:
+            if since.tzinfo is not None:
+                since = since.replace(tzinfo=None) - since.utcoffset()
+            return modified.replace(microsecond=0) <= since
+        return False
+
+    def _cached_response(self, uri, etag, headers):
+        cache = self.local_resource.response_cache
+        mimetype = negotiated_mimetype(self.api)
+        # HTML templates can depend on the session, so they are not cached.
+        if mimetype is None or mimetype == 'text/html':
+            return None
+        key = (str(uri), etag, mimetype)
+        data = cache.get(key)
+        if data is None:
+            result = self.local_resource.read(uri)
+            resp = self.api.representations[mimetype](result, 200, headers)
+            resp.headers['Content-Type'] = mimetype
+            if resp.is_streamed:
+                return resp
+            data = resp.get_data()
+            cache.put(key, data)
+            return resp
+        resp = make_response(data, 200)
+        resp.headers.extend(headers)
+        resp.headers['Content-Type'] = mimetype
+        return resp
+
     def get(self,*args,**kwargs):
         uri = self._get_uri(*args,**kwargs)
+        headers = {}
+        modified = self.local_resource.modified(uri)
+        if modified is not None:
+            etag = version_tag(modified)
+            # weak, because every negotiated representation shares it
+            headers['ETag'] = 'W/"%s"' % etag
+            headers['Vary'] = 'Accept'
+            headers['Last-Modified'] = http_date(modified)
+            if self._not_modified(etag, modified):
+                return None, 304, headers
+            if self.local_resource.response_cache is not None:
+                resp = self._cached_response(uri, etag, headers)
+                if resp is not None:
+                    return resp
         result = self.local_resource.read(uri)
-        return result
+        return result, 200, headers
 
     def delete(self,*args,**kwargs):
         uri = self._get_uri(*args,**kwargs)
@@ -53,21 +170,43 @@ class LinkedDataResource(Resource):
         result = self.local_resource.update(inputGraph, uri)
         return result, 201
 
+stream_chunk_size = 1000
+
 def serializer(mimetype):
     def wrapper(graph, code, headers=None):
         data = ''
-        print(graph)
         if graph is not None and hasattr(graph, "serialize"):
-            data = graph.serialize(format=sadi.contentTypes[mimetype].outputFormat)
+            format = sadi.contentTypes[mimetype].outputFormat
+            if format in line_formats and len(graph) > stream_chunk_size:
+                resp = Response(iter_lines(graph, format, stream_chunk_size), code,
+                                mimetype=mimetype)
+                resp.headers.extend(headers or {})
+                return resp
+            data = graph.serialize(format=format)
         #print data, code, len(graph), mimetype
         resp = make_response(data, code)
         resp.headers.extend(headers or {})
-        print(data)
+        return resp
+    return wrapper
+
+jsonld_types = ('application/json', 'application/ld+json')
+
+def jsonld_serializer(context):
+    def wrapper(graph, code, headers=None):
+        data = ''
+        if graph is not None and hasattr(graph, "serialize"):
+            data = serialize_jsonld(graph, context)
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
         return resp
     return wrapper
 
 def rendertemplate(data, code, headers=None):
     headers = headers or {}
+    if data is None:
+        resp = make_response('', code)
+        resp.headers.extend(headers)
+        return resp
     if isinstance(data,rdfalchemy.rdfSubject):
         uri = data.resUri
     else:
@@ -86,26 +225,32 @@ def rendertemplate(data, code, headers=None):
 class JsonLDSerializer(sadi.DefaultSerializer):
     context = None
     def serialize(self,graph):
-        if self.context != None:
-            self.bindPrefixes(graph)
-            return graph.serialize(format=self.outputFormat,
-                                   context= self.context,encoding='utf-8')
+        return serialize_jsonld(graph, self.context)
 
 
 
 sadi.contentTypes['application/json'] = JsonLDSerializer("json-ld")
 sadi.contentTypes['application/ld+json'] = JsonLDSerializer("json-ld")
+sadi.contentTypes.setdefault('application/n-triples', sadi.DefaultSerializer("nt"))
+sadi.contentTypes.setdefault('application/n-quads', sadi.DefaultSerializer("nquads"))
 class LinkedDataApi(Api):
 
     _local_resources = {}
 
-    def __init__(self, app, api_prefix, store, host_prefix, decorators=[]):
+    def __init__(self, app, api_prefix, store, host_prefix, decorators=[], vocab=None):
         Api.__init__(self, app, prefix=api_prefix)
         self.store = store
         for mimetype in list(sadi.contentTypes.keys()):
             if mimetype is not None:
                 self.representations[mimetype] = serializer(mimetype)
         self.representations['text/html'] = rendertemplate
+        # The JSON-LD context is built once, from the vocabulary's prefixes
+        # or else the store's.
+        if vocab is None:
+            vocab = ConjunctiveGraph(store)
+        self.context = build_context(vocab)
+        for mimetype in jsonld_types:
+            self.representations[mimetype] = jsonld_serializer(self.context)
 
         self.lod_prefix = host_prefix + api_prefix
         self._decorators = decorators
@@ -119,11 +264,13 @@ class LinkedDataApi(Api):
 
         class LDResource(LinkedDataResource):
             decorators = self._decorators
+            api = self
             def __init__(self):
                 LinkedDataResource.__init__(self, resource)
 
         class ListLDResource(LinkedDataResourceList):
             decorators = self._decorators
+            api = self
             def __init__(self):
                 LinkedDataResourceList.__init__(self, resource)
 
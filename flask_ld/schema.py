@@ -0,0 +1,186 @@
+from __future__ import absolute_import
+from builtins import str
+from builtins import object
+import hashlib
+import json
+import os
+import re
+from rdflib import Namespace, URIRef, Literal, RDF, RDFS, OWL
+from rdflib.compare import to_canonical_graph
+
+dc = Namespace("http://purl.org/dc/terms/")
+flaskld = Namespace("http://vocab.rpi.edu/flaskld/")
+
+def qname_label(graph, uri):
+    return re.sub(":_-\/"," ",re.sub("^([^:])+:","",graph.qname(uri)))
+
+def _text(value):
+    if value is None:
+        return None
+    if isinstance(value, Literal):
+        return str(value.value)
+    return str(value)
+
+class FieldSchema(object):
+    def __init__(self, identifier, name, range=None, functional=False,
+                 object_property=False, label=None, description=None, hidden=False,
+                 inverse_functional=False):
+        self.identifier = URIRef(identifier)
+        self.name = name
+        self.range = URIRef(range) if range is not None else None
+        self.functional = functional
+        self.object_property = object_property
+        self.label = label
+        self.description = description
+        self.hidden = hidden
+        self.inverse_functional = inverse_functional
+
+    def to_json(self):
+        return {
+            'identifier': str(self.identifier),
+            'name': self.name,
+            'range': _text(self.range),
+            'functional': self.functional,
+            'object_property': self.object_property,
+            'label': self.label,
+            'description': self.description,
+            'hidden': self.hidden,
+            'inverse_functional': self.inverse_functional,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+class ClassSchema(object):
+    '''Everything create_model, get_form and ModelView need to know about a
+    class, read out of the vocabulary once.'''
+    def __init__(self, identifier, label, fields, view_templates=None, key=None):
+        self.identifier = URIRef(identifier)
+        self.label = label
+        self.fields = fields
+        self.view_templates = view_templates or []
+        self.key = URIRef(key) if key is not None else None
+
+    def field(self, name):
+        for f in self.fields:
+            if f.name == name:
+                return f
+        return None
+
+    def to_json(self):
+        return {
+            'identifier': str(self.identifier),
+            'label': self.label,
+            'fields': [f.to_json() for f in self.fields],
+            'view_templates': self.view_templates,
+            'key': _text(self.key),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        data = dict(data)
+        data['fields'] = [FieldSchema.from_json(f) for f in data['fields']]
+        return cls(**data)
+
+def compile_schema(vocab, cl):
+    clResource = vocab.resource(cl)
+    label = clResource.value(RDFS.label)
+    if label is None:
+        label = qname_label(vocab, cl)
+    else:
+        label = _text(label)
+    fields = []
+    for field in clResource[flaskld.hasField]:
+        name = field.value(flaskld.fieldName)
+        if name is None:
+            name = vocab.qname(field.identifier).split(":")[1].replace("-","_")
+        else:
+            name = _text(name)
+        propRange = field.value(RDFS.range)
+        if propRange is not None:
+            propRange = propRange.identifier
+        fieldLabel = field.value(RDFS.label)
+        if fieldLabel is None:
+            fieldLabel = qname_label(vocab, field.identifier)
+        else:
+            fieldLabel = _text(fieldLabel)
+        fields.append(FieldSchema(
+            field.identifier, name, propRange,
+            functional=bool(field[RDF.type:OWL.FunctionalProperty]),
+            object_property=bool(field[RDF.type:OWL.ObjectProperty]),
+            label=fieldLabel,
+            description=_text(field.value(dc.description)),
+            hidden=bool(clResource[flaskld.hideField:field.identifier]),
+            inverse_functional=bool(field[RDF.type:OWL.InverseFunctionalProperty])))
+    views = [_text(v if isinstance(v, Literal) else v.identifier)
+             for v in clResource[flaskld.hasView]]
+    key = clResource.value(flaskld.key)
+    if key is not None:
+        key = key.identifier
+    return ClassSchema(cl, label, fields, views, key)
+
+def vocab_hash(vocab):
+    '''A hash of the vocabulary's triples, with blank nodes relabelled
+    canonically so that it is the same in every process.'''
+    digest = hashlib.sha1()
+    for line in sorted(' '.join(x.n3() for x in t) for t in to_canonical_graph(vocab)):
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+# bump when the compiled form changes, so that stale files are not reused
+schema_version = 2
+
+def sources_hash(sources):
+    digest = hashlib.sha1()
+    for source in sources:
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class SchemaCache(object):
+    '''Keeps compiled schemas on disk in path, one file per vocabulary
+    version, so that other processes and later restarts can skip
+    compiling. Give the files the vocabulary was loaded from as sources to
+    key the cache on their content, which is cheap; otherwise the
+    vocabulary graph itself is hashed (once per graph), which costs about
+    as much as compiling.'''
+    def __init__(self, path, sources=None):
+        self.path = path
+        self.sources = sources
+        self._hashes = {}
+        self._schemas = {}
+
+    def _file(self, vocab):
+        if id(vocab) not in self._hashes:
+            if self.sources:
+                self._hashes[id(vocab)] = sources_hash(self.sources)
+            else:
+                self._hashes[id(vocab)] = vocab_hash(vocab)
+        return os.path.join(self.path, 'schema-%s-%s.json' % (
+            self._hashes[id(vocab)], schema_version))
+
+    def _load(self, filename):
+        if filename not in self._schemas:
+            schemas = {}
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    schemas = json.load(f)
+            self._schemas[filename] = schemas
+        return self._schemas[filename]
+
+    def get(self, vocab, cl):
+        filename = self._file(vocab)
+        schemas = self._load(filename)
+        if str(cl) in schemas:
+            return ClassSchema.from_json(schemas[str(cl)])
+        schema = compile_schema(vocab, cl)
+        schemas[str(cl)] = schema.to_json()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(schemas, f)
+        os.rename(tmp, filename)
+        return schema
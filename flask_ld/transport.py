@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+from builtins import object
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
+
+class PoolStats(object):
+    def __init__(self, pool_timeout=None):
+        self.pool_timeout = pool_timeout
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.misses = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def record_get(self, wait):
+        with self._lock:
+            self.requests += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hits': self.requests - self.misses,
+                'misses': self.misses,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+                'mean_wait': self.wait_time / self.requests if self.requests else 0.0,
+            }
+
+_connecting = threading.local()
+
+class _StatsPoolMixin(object):
+    stats = None
+
+    def _get_conn(self, timeout=None):
+        if timeout is None:
+            timeout = self.stats.pool_timeout
+        _connecting.time = 0.0
+        start = time.time()
+        conn = super(_StatsPoolMixin, self)._get_conn(timeout=timeout)
+        # time spent creating a new connection is not time spent waiting
+        self.stats.record_get(time.time() - start - _connecting.time)
+        return conn
+
+    def _new_conn(self):
+        self.stats.record_miss()
+        start = time.time()
+        try:
+            return super(_StatsPoolMixin, self)._new_conn()
+        finally:
+            _connecting.time = getattr(_connecting, 'time', 0.0) + time.time() - start
+
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, stats, **kwargs):
+        self.pool_stats = stats
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        attrs = {'stats': self.pool_stats}
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('StatsHTTPConnectionPool', (_StatsPoolMixin, HTTPConnectionPool), attrs),
+            'https': type('StatsHTTPSConnectionPool', (_StatsPoolMixin, HTTPSConnectionPool), attrs),
+        }
+
+class ConnectionPool(object):
+    '''A bounded, keep-alive HTTP connection pool shared by every thread
+    that talks to a SPARQL endpoint. When all connections are in use,
+    callers block for up to pool_timeout seconds. Like rdflib's
+    SPARQLConnector, the session belongs to one process: a forked child
+    (e.g. a pre-forking server worker) gets a new pool, with fresh stats,
+    instead of sharing its parent's sockets.'''
+    def __init__(self, size=10, pool_timeout=None, max_retries=0, hosts=2):
+        self.size = size
+        # one urllib3 pool per host; query and update endpoints can differ
+        self.hosts = max(hosts, 2)
+        self.pool_timeout = pool_timeout
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+        self.adapter = None
+        self._stats = PoolStats(pool_timeout)
+
+    @property
+    def session(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    if self._pid is not None:
+                        # the inherited pool's sockets are the parent's
+                        self._stats = PoolStats(self.pool_timeout)
+                    self.adapter = PooledAdapter(self._stats, pool_connections=self.hosts,
+                                                 pool_maxsize=self.size, pool_block=True,
+                                                 max_retries=self.max_retries)
+                    session = requests.Session()
+                    session.mount('http://', self.adapter)
+                    session.mount('https://', self.adapter)
+                    self._session = session
+                    self._pid = pid
+        return self._session
+
+    def stats(self):
+        result = self._stats.snapshot()
+        result['size'] = self.size
+        return result
+
+    def close(self):
+        if self._session is not None and self._pid == os.getpid():
+            self._session.close()
+
+class PooledSPARQLUpdateStore(SPARQLUpdateStore):
+    def __init__(self, *args, **kwargs):
+        self.transport = kwargs.pop('transport')
+        SPARQLUpdateStore.__init__(self, *args, **kwargs)
+
+    @property
+    def session(self):
+        return self.transport.session
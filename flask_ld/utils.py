@@ -1,7 +1,9 @@
 from __future__ import print_function
 from builtins import str
 from builtins import object
-import re, threading, traceback, datetime
+import re, threading, traceback, datetime, time, os, binascii
+from collections import OrderedDict
+from contextlib import contextmanager
 from rdflib import Literal
 
 def timer(fn):
@@ -27,46 +29,203 @@ def get_max_id(c, graph):
         else:
             return Literal(result)
 
+_crockford = '0123456789abcdefghjkmnpqrstvwxyz'
+
+class IdAllocator(object):
+    '''Allocates ULID-style identifiers: 26 characters of (lowercase)
+    Crockford base32 encoding a 48-bit millisecond timestamp followed by 80
+    random bits. Identifiers sort by allocation time and are strictly
+    increasing within a process; ids from different processes are kept
+    apart by the random bits, so allocation never needs the store.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last_time = 0
+        self._last_random = 0
+
+    def _random(self):
+        return int(binascii.hexlify(os.urandom(10)), 16)
+
+    def __call__(self):
+        with self._lock:
+            now = int(time.time() * 1000)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._last_time = 0
+            if now <= self._last_time:
+                now = self._last_time
+                self._last_random += 1
+                if self._last_random >> 80:
+                    now += 1
+                    self._last_random = self._random()
+            else:
+                self._last_random = self._random()
+            self._last_time = now
+            value = (now << 80) | self._last_random
+        chars = []
+        for i in range(26):
+            chars.append(_crockford[value & 31])
+            value >>= 5
+        return ''.join(reversed(chars))
+
+allocate_id = IdAllocator()
+
 def print_stacktrace():
     for line in traceback.format_stack()[:-1]:
         print(line.strip())
 
-def lru(original_function, maxsize=1000):
-    mapping = {}
-
-    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3         # link fields
-    head = [None, None, None, None]        # oldest
-    tail = [head, None, None, None]   # newest
-    head[NEXT] = tail
+_missing = object()
 
+def lru(original_function, maxsize=1000, ttl=None):
+    cache = Cache(maxsize=maxsize, ttl=ttl)
     def fn(*args, **kw):
         key = (args,tuple(kw.items()))
-        PREV, NEXT = 0, 1
-        #print "Cache lookup for "+str(key)
-        link = mapping.get(key, head)
-        if link is head:
-            #print "Cache miss for "+str(key)
+        value = cache.get(key, _missing)
+        if value is _missing:
             value = original_function(*args,**kw)
-            if len(mapping) >= maxsize:
-                old_prev, old_next, old_key, old_value = head[NEXT]
-                head[NEXT] = old_next
-                old_next[PREV] = head
-                del mapping[old_key]
-            last = tail[PREV]
-            link = [last, tail, key, value]
-            mapping[key] = last[NEXT] = tail[PREV] = link
-        else:
-            #print "Cache hit for "+str(key)
-            link_prev, link_next, key, value = link
-            link_prev[NEXT] = link_next
-            link_next[PREV] = link_prev
-            last = tail[PREV]
-            last[NEXT] = tail[PREV] = link
-            link[PREV] = last
-            link[NEXT] = tail
+            cache.put(key, value)
         return value
+    fn.cache = cache
     return fn
 
+class Cache(object):
+    '''A thread-safe LRU cache bounded by entry count, by total size
+    (as measured by sizeof), or both, with an optional time-to-live in
+    seconds. Entries can be invalidated by key or, for string keys (or
+    tuples starting with one), by prefix.'''
+    def __init__(self, maxsize=1000, maxbytes=None, sizeof=None, ttl=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda value: 1)
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, expires = entry
+            if expires is not None and expires < time.time():
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._discard(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._entries[key] = (value, size, expires)
+            self.bytes += size
+            while self._entries and (
+                    (self.maxsize is not None and len(self._entries) > self.maxsize) or
+                    (self.maxbytes is not None and self.bytes > self.maxbytes)):
+                old_key, (old_value, old_size, old_expires) = self._entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+    def _discard(self, key):
+        if key in self._entries:
+            value, size, expires = self._entries.pop(key)
+            self.bytes -= size
+            return True
+        return False
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._discard(key):
+                self.invalidations += 1
+                return True
+            return False
+
+    def invalidate_prefix(self, prefix):
+        def text(key):
+            if isinstance(key, tuple) and len(key) > 0:
+                key = key[0]
+            if isinstance(key, str):
+                return key
+            return None
+        with self._lock:
+            keys = [k for k in self._entries
+                    if text(k) is not None and text(k).startswith(prefix)]
+            for key in keys:
+                self._discard(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def invalidate_if(self, predicate):
+        with self._lock:
+            keys = [k for k, (value, size, expires) in self._entries.items()
+                    if predicate(k, value)]
+            for key in keys:
+                self._discard(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+line_formats = ('nt', 'nquads')
+
+def iter_lines(graph, format, chunk_size=1000):
+    '''Serialize a graph as N-Triples or N-Quads, yielding encoded chunks of
+    chunk_size lines straight from the triple iterator.'''
+    from rdflib.plugins.serializers.nt import _nt_row
+    from rdflib.plugins.serializers.nquads import _nq_row
+    if format == 'nquads':
+        if hasattr(graph, 'quads'):
+            rows = (_nq_row((s, p, o), c.identifier) for s, p, o, c in graph.quads((None, None, None)))
+        else:
+            rows = (_nq_row(t, graph.identifier) for t in graph)
+    else:
+        rows = (_nt_row(t) for t in graph)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+
 _slugify_strip_re = re.compile(r'[^\w\s-]')
 _slugify_hyphenate_re = re.compile(r'[-\s]+')
 def slugify(value):
@@ -83,27 +242,96 @@ def slugify(value):
     value = str(_slugify_strip_re.sub('', value).strip().lower())
     return _slugify_hyphenate_re.sub('-', value)
 
-# TODO: There's a risk of the exlusive lock being starved during lots of reads.
-class ShLock(object):
-    xlock = threading.RLock()
-    shlock = threading.Condition()
-    lock_count = 0
+class RWLock(object):
+    '''A reader/writer lock that prefers writers: once a writer is waiting,
+    new readers block until it is done. Both modes are reentrant for the
+    thread holding them, and the writing thread may also take the shared
+    lock. Upgrading a shared lock to an exclusive one is not supported.'''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self.acquisitions = {True: 0, False: 0}
+        self.contentions = {True: 0, False: 0}
+        self.wait_time = {True: 0.0, False: 0.0}
+
+    def _reads(self):
+        return getattr(self._local, 'reads', 0)
 
     def acquire(self,exclusive=True):
-        if exclusive:
-            self.xlock.acquire()
-        else:
-            self.shlock.acquire()
-            while self.lock_count == 0 and not self.xlock.acquire(False):
-                self.shlock.wait()
-            self.lock_count += 1
-            self.shlock.release()
+        me = threading.current_thread()
+        start = time.time()
+        contended = False
+        with self._cond:
+            if exclusive:
+                if self._writer is me:
+                    self._write_depth += 1
+                    return
+                if self._reads() > 0:
+                    raise RuntimeError("Cannot upgrade a shared lock to an exclusive lock.")
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers > 0:
+                        contended = True
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer = me
+                self._write_depth = 1
+            else:
+                if self._writer is not me and self._reads() == 0:
+                    while self._writer is not None or self._writers_waiting > 0:
+                        contended = True
+                        self._cond.wait()
+                self._readers += 1
+                self._local.reads = self._reads() + 1
+            self.acquisitions[exclusive] += 1
+            if contended:
+                self.contentions[exclusive] += 1
+                self.wait_time[exclusive] += time.time() - start
 
     def release(self,exclusive=True):
-        if exclusive:
-            self.xlock.release()
-            self.shlock.notify_all()
-        else:
-            self.shlock.acquire()
-            self.lock_count -= 1
-            self.shlock.release()
+        with self._cond:
+            if exclusive:
+                if self._writer is not threading.current_thread():
+                    raise RuntimeError("Cannot release an exclusive lock that is not held.")
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    self._writer = None
+                    self._cond.notify_all()
+            else:
+                if self._reads() == 0:
+                    raise RuntimeError("Cannot release a shared lock that is not held.")
+                self._local.reads -= 1
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire(False)
+        try:
+            yield self
+        finally:
+            self.release(False)
+
+    @contextmanager
+    def exclusive(self):
+        self.acquire(True)
+        try:
+            yield self
+        finally:
+            self.release(True)
+
+    def stats(self):
+        with self._cond:
+            return dict([(mode, {
+                'acquisitions': self.acquisitions[exclusive],
+                'contentions': self.contentions[exclusive],
+                'wait_time': self.wait_time[exclusive],
+            }) for mode, exclusive in [('shared', False), ('exclusive', True)]])
+
+ShLock = RWLock
@@ -0,0 +1,215 @@
+from __future__ import absolute_import
+from builtins import object
+import threading
+import time
+from rdflib import Graph, ConjunctiveGraph, URIRef, BNode
+from rdflib.plugins.stores.sparqlstore import SPARQLStore
+
+def is_remote(store):
+    return isinstance(store, SPARQLStore)
+
+def has_blank(triple):
+    return any(isinstance(x, BNode) for x in triple)
+
+def data_block(graph_uri, triples):
+    return 'GRAPH %s {\n%s\n}' % (graph_uri.n3(), '\n'.join(
+        '%s %s %s .' % (s.n3(), p.n3(), o.n3()) for s, p, o in triples))
+
+_default = object()
+
+def is_transient(error):
+    if not isinstance(error, (IOError, OSError)):
+        return False
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(error, 'code', None)
+    if isinstance(status, int) and status < 500:
+        return False
+    return True
+
+class BatchWriter(object):
+    '''Writes triples into named graphs. Remote SPARQL stores receive
+    INSERT DATA requests of at most batch_size triples, retried with
+    exponential backoff on transient (network or 5xx) failures; local
+    stores get addN calls of the same size. Triples containing blank nodes
+    are always sent together in one batch so that their blank nodes stay
+    connected. That batch is never retried: if a failed attempt was in fact
+    applied, inserting fresh blank nodes again would duplicate the data.'''
+    def __init__(self, store, batch_size=1000, retries=3, backoff=0.5):
+        self.store = store
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self.triples = 0
+        self.batches = 0
+        self.retried = 0
+        self.elapsed = 0.0
+
+    def _batches(self, quads, batch_size):
+        if batch_size is None:
+            quads = list(quads)
+            if quads:
+                yield quads
+            return
+        ground = []
+        blank = []
+        for quad in quads:
+            if has_blank(quad[:3]):
+                blank.append(quad)
+            else:
+                ground.append(quad)
+                if len(ground) >= batch_size:
+                    yield ground
+                    ground = []
+        if ground:
+            yield ground
+        if blank:
+            yield blank
+
+    def _insert_data(self, quads):
+        graphs = {}
+        for s, p, o, g in quads:
+            graphs.setdefault(g, []).append((s, p, o))
+        return 'INSERT DATA {\n%s\n}' % '\n'.join(
+            data_block(g, triples) for g, triples in graphs.items())
+
+    def _send(self, query, retry=True):
+        attempt = 0
+        pending = query
+        while True:
+            try:
+                if pending is not None:
+                    update, pending = pending, None
+                    self.store.update(update)
+                self.store.commit()
+                return
+            except Exception as e:
+                if not retry or not is_transient(e) or attempt >= self.retries:
+                    self.store.rollback()
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def _record(self, count, start):
+        with self._lock:
+            self.triples += count
+            self.batches += 1
+            self.elapsed += time.time() - start
+
+    def write_quads(self, quads, prefix=None, batch_size=_default):
+        '''Writes (s, p, o, graph URI) quads. If given, the update operations
+        in prefix are sent in the same request as the first batch. With
+        batch_size=None everything is written as one batch, which remote
+        stores receive as a single, all-or-nothing request.'''
+        if batch_size is _default:
+            batch_size = self.batch_size
+        remote = is_remote(self.store)
+        graphs = {}
+        total = 0
+        for batch in self._batches(quads, batch_size):
+            start = time.time()
+            if remote:
+                query = self._insert_data(batch)
+                if prefix:
+                    query = ' ;\n'.join(prefix + [query])
+                    prefix = None
+                self._send(query, retry=not any(has_blank(q[:3]) for q in batch))
+            else:
+                for s, p, o, g in batch:
+                    if g not in graphs:
+                        graphs[g] = Graph(self.store, g)
+                self.store.addN((s, p, o, graphs[g]) for s, p, o, g in batch)
+            self._record(len(batch), start)
+            total += len(batch)
+        if prefix and remote:
+            self._send(' ;\n'.join(prefix))
+        return total
+
+    def write(self, graph_uri, triples, prefix=None):
+        graph_uri = URIRef(graph_uri)
+        return self.write_quads(((s, p, o, graph_uri) for s, p, o in triples), prefix)
+
+    def apply_delta(self, uri, removals, additions, blank=False, foreign=False):
+        '''Applies a delta from flaskld.graph_delta to the named graph uri.
+        If foreign is True, triples about uri in other graphs are deleted as
+        well. On remote stores the deletions are sent in the same request as
+        the first batch of insertions.'''
+        uri = URIRef(uri)
+        if not is_remote(self.store):
+            idb = Graph(self.store, uri)
+            if foreign:
+                for s, p, o, c in ConjunctiveGraph(self.store).quads((uri, None, None)):
+                    if c.identifier != uri:
+                        self.store.remove((s, p, o), c)
+            for t in removals:
+                self.store.remove(t, idb)
+            return self.write(uri, additions)
+        operations = []
+        if foreign:
+            operations.append('''DELETE { GRAPH ?g { %s ?p ?o } }
+WHERE { GRAPH ?g { %s ?p ?o } FILTER(?g != %s) }''' % (uri.n3(), uri.n3(), uri.n3()))
+        ground = [t for t in removals if not has_blank(t)]
+        if ground:
+            operations.append('DELETE DATA {\n%s\n}' % data_block(uri, ground))
+        if blank:
+            operations.append('''DELETE { GRAPH %s { ?s ?p ?o } }
+WHERE { GRAPH %s { ?s ?p ?o FILTER(isBlank(?s) || isBlank(?o)) } }''' % (uri.n3(), uri.n3()))
+        return self.write(uri, additions, operations)
+
+    def touch(self, uris, pred, value):
+        '''Sets pred to value on each of uris, in the graph named by the
+        uri, wherever it already has a value there.'''
+        uris = [URIRef(uri) for uri in uris]
+        if not uris:
+            return
+        if not is_remote(self.store):
+            for uri in uris:
+                idb = Graph(self.store, uri)
+                if idb.value(uri, pred) is not None:
+                    idb.set((uri, pred, value))
+            return
+        self._send(' ;\n'.join('''DELETE { GRAPH %(g)s { %(g)s %(p)s ?old } }
+INSERT { GRAPH %(g)s { %(g)s %(p)s %(v)s } }
+WHERE { GRAPH %(g)s { %(g)s %(p)s ?old } }''' % {'g': uri.n3(), 'p': pred.n3(), 'v': value.n3()}
+                               for uri in uris))
+
+    def graph_exists(self, uri):
+        uri = URIRef(uri)
+        if is_remote(self.store):
+            result = ConjunctiveGraph(self.store).query('ASK { GRAPH %s { ?s ?p ?o } }' % uri.n3())
+            return bool(result.askAnswer)
+        for triple in self.store.triples((None, None, None), Graph(self.store, uri)):
+            return True
+        return False
+
+    def delete_resource(self, uri):
+        '''Drops the named graph uri and every triple, in any graph, with
+        uri as its subject or object. Remote stores receive this as a single
+        SPARQL Update request.'''
+        uri = URIRef(uri)
+        if not is_remote(self.store):
+            self.store.remove((None, None, None), Graph(self.store, uri))
+            if getattr(self.store, 'graph_aware', False):
+                self.store.remove_graph(Graph(self.store, uri))
+            self.store.remove((uri, None, None), None)
+            self.store.remove((None, None, uri), None)
+            return
+        self._send(' ;\n'.join([
+            'DROP SILENT GRAPH %s' % uri.n3(),
+            'DELETE WHERE { %s ?p ?o }' % uri.n3(),
+            'DELETE WHERE { GRAPH ?g { %s ?p ?o } }' % uri.n3(),
+            'DELETE WHERE { ?s ?p %s }' % uri.n3(),
+            'DELETE WHERE { GRAPH ?g { ?s ?p %s } }' % uri.n3(),
+        ]))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'triples': self.triples,
+                'batches': self.batches,
+                'retries': self.retried,
+                'elapsed': self.elapsed,
+                'triples_per_second': self.triples / self.elapsed if self.elapsed else 0.0,
+            }
@@ -33,7 +33,8 @@ install_requires=[
     "Flask",
     "flask-security",
     'Flask-RESTful',
-    'RDFAlchemy'
+    'RDFAlchemy',
+    'requests'
     ]
 
 setup(